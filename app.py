@@ -1,21 +1,107 @@
 import os
+import re
+import time
 import pandas as pd
 import streamlit as st
 from loguru import logger
 from openai import OpenAI
 from token_count import num_messages, num_tokens_from_string
 from llm_service import MODELS, create_client_for_model
-from repo_service import RepoManager
+from repo_service import CLONE_STRATEGIES, RepoManager
+from config import Config
+from render_modes import RENDER_MODES
 
+RENDER_MODE_LABELS = {
+    "full": "Full",
+    "no_comments": "Without Comments",
+    "compact": "Compact",
+    "outline": "Outline",
+}
 
-class StreamHandler:
-    def __init__(self, container, initial_text=""):
+
+class StreamRenderer:
+    """Renders a streamed reply into a container without redrawing it per token.
+
+    Tokens are buffered and flushed at most every flush_interval seconds (or
+    once flush_chars are pending). Finished paragraphs outside code fences are
+    frozen into their own element, so a flush only redraws the paragraph being
+    written. Time to first token and tokens per second are measured from start;
+    a reply from the response cache is reported as cached instead.
+    """
+
+    def __init__(self, container, flush_interval=0.05, flush_chars=2000, start=None):
         self.container = container
-        self.text = initial_text
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self.start = start or time.perf_counter()
+        self.frozen = []
+        self.tail = ""
+        self.pending = []
+        self.pending_chars = 0
+        self.placeholder = container.empty()
+        self.last_flush = self.start
+        self.first_token_at = None
+        self.finished_at = None
+        self.cached = False
+
+    @property
+    def text(self):
+        return "".join(self.frozen) + self.tail + "".join(self.pending)
+
+    def process_token(self, token):
+        if not token:
+            return
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.pending.append(token)
+        self.pending_chars += len(token)
+        if now - self.last_flush >= self.flush_interval or self.pending_chars >= self.flush_chars:
+            self.flush()
 
-    def process_token(self, token: str):
-        self.text += token
-        self.container.markdown(self.text)
+    def flush(self):
+        if not self.pending:
+            return
+        self.tail += "".join(self.pending)
+        self.pending = []
+        self.pending_chars = 0
+        self.last_flush = time.perf_counter()
+        done = self._frozen_prefix_length(self.tail)
+        if done:
+            # the finished paragraphs stay in the current element, the rest moves to a new one
+            self.placeholder.markdown(self.tail[:done])
+            self.frozen.append(self.tail[:done])
+            self.tail = self.tail[done:]
+            self.placeholder = self.container.empty()
+        if self.tail:
+            self.placeholder.markdown(self.tail)
+
+    @staticmethod
+    def _frozen_prefix_length(text):
+        """Length of the leading complete paragraphs of text that are not inside a code fence."""
+        end = text.rfind("\n\n")
+        while end != -1 and text.count("```", 0, end) % 2:
+            end = text.rfind("\n\n", 0, end)
+        return 0 if end == -1 else end + 2
+
+    def finish(self, cached=False):
+        self.flush()
+        self.finished_at = time.perf_counter()
+        self.cached = cached
+        return self.metrics()
+
+    def metrics(self):
+        """Time to first token and generation speed of the reply, once finished."""
+        if self.first_token_at is None:
+            return {"ttft": None, "tokens": 0, "tokens_per_second": None, "cached": self.cached}
+        tokens = num_tokens_from_string(self.text)
+        generation_time = (self.finished_at or time.perf_counter()) - self.first_token_at
+        return {
+            "ttft": self.first_token_at - self.start,
+            "tokens": tokens,
+            "tokens_per_second": tokens / generation_time if generation_time > 0 else None,
+            "cached": self.cached,
+        }
 
 def refresh_repos():
     logger.info("Refreshing repositories")
@@ -24,6 +110,37 @@ def refresh_repos():
     st.session_state['repoManager'].load_repos()
     st.success("Refreshed repositories")
 
+def show_jobs(repoManager):
+    """Progress of queued and running repository jobs, and the outcome of recent ones."""
+    for job in repoManager.jobs.active_jobs():
+        label = f"{job['kind'].capitalize()} {job['repo_url']}"
+        if job['status'] == 'queued':
+            st.caption(f"{label}: queued")
+        elif job['total']:
+            st.progress(min(job['done'] / job['total'], 1.0),
+                        text=f"{label}: {job['stage']} {job['done']}/{job['total']}")
+        else:
+            st.progress(0, text=f"{label}: {job['stage'] or 'starting'}")
+    recent_jobs = repoManager.jobs.recent_jobs()
+    if recent_jobs:
+        with st.expander("Recent Jobs"):
+            st.dataframe(pd.DataFrame(recent_jobs)[['id', 'kind', 'repo_url', 'status', 'error']],
+                         hide_index=True)
+
+
+def poll_jobs(repoManager):
+    """Rerun the script shortly while jobs are pending, so their progress and results show up."""
+    if repoManager.jobs.active_jobs():
+        time.sleep(Config.get("job_poll_interval", 1.0))
+        st.rerun()
+
+
+def add_files_to_selection(file_paths):
+    selected = st.session_state.get("selected_files", [])
+    st.session_state["selected_files"] = selected + \
+        [file_path for file_path in file_paths if file_path not in selected]
+
+
 def create_app():
     st.set_page_config(page_title="ChatWithRepo", page_icon="🤖")
 
@@ -36,54 +153,114 @@ def create_app():
     with st.sidebar:
         st.title("Settings for Repo")
         custom_repo_url = st.text_input("Custom Repository URL")
+        clone_strategy = st.selectbox(
+            "Clone Strategy", options=CLONE_STRATEGIES,
+            index=CLONE_STRATEGIES.index(Config.get("clone_strategy", "full")))
+        sparse_patterns = []
+        if clone_strategy == "sparse":
+            sparse_patterns = [pattern.strip() for pattern in st.text_input(
+                "Sparse Patterns (comma separated)", value=", ".join(Config.get("sparse_patterns") or [])).split(",") if pattern.strip()]
         col1, col2 = st.columns(2)
         with col1:
             if st.button("Add Custom Repository"):
-                if repoManager.add_repo(custom_repo_url):
-                    st.success(f"Added custom repository: {custom_repo_url}")
+                if not custom_repo_url:
+                    st.error("Enter a repository URL first")
+                elif repoManager.check_if_repo_exists(custom_repo_url):
+                    st.warning(f"Repository already exists: {custom_repo_url}")
                 else:
-                    st.error(f"Repository add failed: {custom_repo_url}")
-                repo_url = custom_repo_url
+                    repoManager.submit_job(
+                        "add", custom_repo_url, clone_strategy=clone_strategy, sparse_patterns=sparse_patterns)
+                    st.info(f"Adding repository in the background: {custom_repo_url}")
         with col2:
             if st.button("Refresh Repositories"):
                 refresh_repos()
-            
+        show_jobs(repoManager)
+
+        def format_repo(repo_url):
+            summary = repoManager.get_repo_summary(repo_url) or {}
+            if summary.get("file_count") is None:
+                return repo_url
+            return f"{repo_url} ({summary['file_count']} files, {summary['token_count']:,} tokens)"
+
         repo_url = st.selectbox(
-            "Repository URL", options=repoManager.get_repo_urls())
+            "Repository URL", options=repoManager.get_repo_urls(), format_func=format_repo)
         if repoManager.check_if_repo_exists(repo_url):
             repo = repoManager.get_repo_service(repo_url)
+            folder_stats = repo.get_folder_stats()
+
+            def format_folder(folder):
+                files, tokens = folder_stats.get(folder, (0, 0))
+                return f"{folder or '/'} ({files} files, {tokens:,} tokens)"
+
             selected_folder = st.multiselect(
-                "Select Folder", options=repo.get_folders_options())
+                "Select Folder", options=repo.get_folders_options(), format_func=format_folder)
+            files_options = repo.get_files_options()
+            if "selected_files" not in st.session_state:
+                st.session_state["selected_files"] = ["README.md"]
+            # drop files of a previously selected repository
+            st.session_state["selected_files"] = [
+                file for file in st.session_state["selected_files"] if file in files_options]
             selected_files = st.multiselect(
-                "Select Files", options=repo.get_files_options(), default="README.md")
+                "Select Files", options=files_options, key="selected_files")
             selected_languages = st.multiselect(
                 "Filtered by Language", options=repo.get_languages_options())
+            selected_globs = [pattern.strip() for pattern in st.text_input(
+                "Select by Glob (comma separated)", placeholder="src/*.py, docs/*.md").split(",") if pattern.strip()]
+            selected_patterns = []
+            path_regex = st.text_input("Select by Regex")
+            if path_regex:
+                try:
+                    re.compile(path_regex)
+                    selected_patterns = [path_regex]
+                except re.error as e:
+                    st.error(f"Invalid regex: {e}")
+            search_query = st.text_input(
+                "Search Contents", placeholder="identifier or text")
+            if search_query:
+                search_results = repo.search(search_query)
+                if search_results.empty:
+                    st.caption("No matches.")
+                else:
+                    matched_files = [file for file in search_results['file_path'].unique()
+                                     if file in files_options]
+                    with st.expander(f"Search Results ({len(matched_files)} files)", expanded=True):
+                        st.dataframe(search_results, hide_index=True)
+                    st.button("Add Matches to Selected Files",
+                              on_click=add_files_to_selection, args=(matched_files,))
             limit = st.number_input("Limit", value=100000, step=10000)
+            rank_by_question = st.checkbox(
+                "Rank Files by Question", help="Pack the files most relevant to each question within the limit instead of the first ones.")
+            split_files = st.checkbox(
+                "Split Large Files into Chunks", help="Let large files contribute only the functions and classes that fit, keeping the signatures of the rest.")
+            granularity = "chunk" if split_files else "file"
+            render_mode = st.selectbox(
+                "Render Mode", options=RENDER_MODES, format_func=lambda mode: RENDER_MODE_LABELS[mode],
+                help="Trade detail for size: drop comments and blank lines, also collapse whitespace, or keep only imports, signatures and docstrings.")
+            skipped_files = repo.get_skipped_files()
+            if not skipped_files.empty:
+                with st.expander(f"Skipped Files ({len(skipped_files)})"):
+                    st.dataframe(skipped_files, hide_index=True)
             col1, col2, col3 = st.columns(3)
             with col1:
                 if st.button("Count Tokens"):
-                    file_string = repo.get_filtered_files(
+                    _, file_tokens = repo.build_context(
                         selected_folders=selected_folder,
                         selected_files=selected_files,
                         selected_languages=selected_languages,
+                        selected_globs=selected_globs,
+                        selected_patterns=selected_patterns,
                         limit=limit,
+                        granularity=granularity,
+                        render_mode=render_mode,
                     )
-                    st.write(
-                        f"Total Tokens: {num_tokens_from_string(file_string)}")
+                    st.write(f"Total Tokens: {file_tokens}")
             with col2:
                 if st.button("Update Repo"):
-                    if repo.update_repo():
-                        st.success(f"Updated repository: {repo_url}")
-                    else:
-                        st.error(f"Repository update failed: {repo_url}")
+                    repoManager.submit_job("update", repo_url)
                     st.rerun()
             with col3:
                 if st.button("Delete Repo"):
-                    if repo.delete_repo():
-                        st.success(f"Deleted repository: {repo_url}")
-                    else:
-                        st.error(f"Repository delete failed: {repo_url}")
-                    refresh_repos()
+                    repoManager.submit_job("delete", repo_url)
                     st.rerun()
 
         st.title("Settings for LLM")
@@ -105,10 +282,12 @@ def create_app():
 
     if repoManager.isEmpty():
         st.info("Copy the repository URL and click the download button.")
+        poll_jobs(repoManager)
         st.stop()
 
     if not repoManager.check_if_repo_exists(repo_url):
         st.info(f"{repo_url} does not exist. Please add the repository first.")
+        poll_jobs(repoManager)
         st.stop()
 
     repo = repoManager.get_repo_service(repo_url)
@@ -121,6 +300,8 @@ def create_app():
     Files : {selected_files}
     Folder: {selected_folder}
     Languages: {selected_languages}
+    Globs: {selected_globs}
+    Regex: {selected_patterns}
     Limit: {limit}
     """
     )
@@ -141,18 +322,24 @@ def create_app():
             st.session_state.client = create_client_for_model(selected_model)
             st.session_state.selected_model = selected_model
 
-        file_string = repo.get_filtered_files(
+        file_string, file_tokens = repo.build_context(
             selected_folders=selected_folder,
             selected_files=selected_files,
             selected_languages=selected_languages,
+            selected_globs=selected_globs,
+            selected_patterns=selected_patterns,
             limit=limit,
+            question=prompt if rank_by_question else None,
+            granularity=granularity,
+            render_mode=render_mode,
         )
         end_time = pd.Timestamp.now()
         logger.info(
             f"Time taken to get filtered files: {end_time - start_time}")
 
         with st.chat_message("assistant"):
-            stream_handler = StreamHandler(st.empty())
+            stream_renderer = StreamRenderer(
+                st.container(), flush_interval=Config.get("stream_flush_interval", 0.05))
             # only add file content to the system prompt
             messages = (
                 [{"role": "system", "content": system_prompt}]
@@ -166,25 +353,54 @@ def create_app():
             logger.info(
                 f"Information: {selected_files}, {selected_folder}, {selected_languages}")
             logger.info(f"Using settings: {selected_model}, {temperature}")
-            logger.info(f"File token: {num_tokens_from_string(file_string)}")
+            logger.info(f"File token: {file_tokens}")
             logger.info(f"Total Messages Token: {total_tokens}")
             st.sidebar.write(
                 f"Sending file content: {selected_files} and filter folder: {selected_folder} to the assistant.")
             st.sidebar.write(f"total messages token: {total_tokens}")
+            if (rank_by_question or split_files) and limit:
+                dropped = repo.plan_context(
+                    prompt if rank_by_question else None,
+                    selected_folders=selected_folder,
+                    selected_files=selected_files,
+                    selected_languages=selected_languages,
+                    selected_globs=selected_globs,
+                    selected_patterns=selected_patterns,
+                    limit=limit,
+                    granularity=granularity,
+                    render_mode=render_mode,
+                ).dropped
+                if not dropped.empty:
+                    label = "Dropped Chunks" if split_files else "Dropped Files"
+                    columns = ['file_path', 'name', 'token_count', 'relevance'] if split_files else [
+                        'file_path', 'token_count', 'relevance']
+                    with st.sidebar.expander(f"{label} ({len(dropped)})"):
+                        st.dataframe(dropped[columns].sort_values(
+                            'relevance', ascending=False), hide_index=True)
 
-            # send to llm
-            completion = client.chat(
-                messages, stream=True, temperature=temperature, model=selected_model
+            # send to llm, the system prompt and file content form the cacheable prefix
+            stream_renderer.start = time.perf_counter()
+            text_stream = client.stream_text(
+                messages, temperature=temperature, model=selected_model, context_messages=2
             )
-
-            for chunk in completion:
-                content = chunk.choices[0].delta.content
-                stream_handler.process_token(content)
+            for content in text_stream:
+                stream_renderer.process_token(content)
+            metrics = stream_renderer.finish(cached=text_stream.cached)
+            if metrics["ttft"] is not None:
+                details = [f"First token after {metrics['ttft']:.2f}s", f"{metrics['tokens']} tokens"]
+                if metrics["cached"]:
+                    details.append("cached")
+                elif metrics["tokens_per_second"]:
+                    details.append(f"{metrics['tokens_per_second']:.1f} tokens/s")
+                st.caption(", ".join(details))
+                logger.info(f"Stream metrics: {metrics}")
 
             st.session_state.messages.append(
-                {"role": "assistant", "content": stream_handler.text}
+                {"role": "assistant", "content": stream_renderer.text}
             )
 
+    poll_jobs(repoManager)
+
 
 if __name__ == "__main__":
     create_app()
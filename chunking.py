@@ -0,0 +1,173 @@
+from pygments.lexers import find_lexer_class
+from pygments.token import Comment, Keyword, Name, Operator, Punctuation, String, Text
+from config import Config
+
+# files with fewer tokens are kept whole
+DEFAULT_CHUNK_MIN_TOKENS = 2000
+# lines of a definition kept as its signature when its parameters span several lines
+MAX_SIGNATURE_LINES = 8
+
+FUNCTION_KEYWORDS = {'def', 'defp', 'fn', 'fun', 'func', 'function', 'sub', 'proc', 'method'}
+CLASS_KEYWORDS = {'class', 'struct', 'interface', 'trait', 'impl', 'enum', 'union', 'module', 'defmodule',
+                  'object', 'namespace', 'type', 'record', 'protocol', 'extension'}
+
+
+def get_chunk_min_tokens():
+    return Config.get("chunk_min_tokens", DEFAULT_CHUNK_MIN_TOKENS)
+
+
+def lex(content, language):
+    """Pygments token stream of content as a list, or None if the language has no lexer."""
+    lexer_class = find_lexer_class(language) if language else None
+    if lexer_class is None:
+        return None
+    # keep leading/trailing blank lines so line numbers match the content
+    lexer = lexer_class(stripnl=False, ensurenl=False)
+    return list(lexer.get_tokens(content))
+
+
+def line_tokens(tokens):
+    """Significant (non-whitespace) tokens grouped per line."""
+    lines = [[]]
+    # token type containment checks walk the type hierarchy, so do them once per type
+    is_text = {}
+    for ttype, value in tokens:
+        if ttype not in is_text:
+            is_text[ttype] = ttype in Text
+        parts = value.split('\n')
+        for i, part in enumerate(parts):
+            if i:
+                lines.append([])
+            if not is_text[ttype] and part.strip():
+                lines[-1].append((ttype, part))
+    return lines
+
+
+def definition(tokens):
+    """(kind, name) if a line opens a function or class definition, else None.
+
+    Lexers that tag definitions emit Name.Function / Name.Class, which only count
+    when preceded by keywords and punctuation (so calls like "super().__init__()"
+    do not). Lexers that do not tag them are matched on a leading definition keyword.
+    """
+    keyword_kind = None
+    depth = 0
+    for ttype, value in tokens:
+        if ttype in Name.Function:
+            return 'function', value
+        if ttype in Name.Class:
+            return 'class', value
+        if ttype in Keyword:
+            if value in FUNCTION_KEYWORDS and keyword_kind is None:
+                keyword_kind = 'function'
+            elif value in CLASS_KEYWORDS and keyword_kind is None:
+                keyword_kind = 'class'
+            continue
+        if ttype in Punctuation or ttype in Operator:
+            depth += value.count('(') - value.count(')')
+            continue
+        if keyword_kind and ttype in Name and depth <= 0:
+            return keyword_kind, value
+        if not keyword_kind or depth <= 0:
+            return None
+    return None
+
+
+def is_preamble(tokens):
+    """Comment or decorator lines that belong to the definition below them."""
+    if not tokens:
+        return False
+    if all(ttype in Comment for ttype, _ in tokens):
+        return True
+    return tokens[0][0] in Name.Decorator or tokens[0][1] in ('@', '#[')
+
+
+def indent_of(line):
+    return len(line) - len(line.lstrip())
+
+
+def split_chunks(content, language, tokens=None):
+    """Split content at top-level function and class boundaries.
+
+    Each chunk runs from a definition (with the comments and decorators right
+    above it) to the next one; methods split their class, functions nested in
+    functions do not. Whatever precedes the first definition is a 'header'
+    chunk. Returns a list of dicts with 1-based inclusive start_line/end_line,
+    kind, name and signature, or [] if the file does not split in two. tokens
+    is the lex() output if it is already at hand.
+    """
+    if tokens is None:
+        tokens = lex(content, language)
+    if tokens is None:
+        return []
+    lines = content.split('\n')
+    significant_lines = line_tokens(tokens)[:len(lines)]
+
+    starts = []
+    stack = []  # (indent, kind) of the definitions enclosing the current line
+    signature_end = -1
+    for i, line in enumerate(significant_lines):
+        if not line or is_preamble(line):
+            continue
+        indent = indent_of(lines[i])
+        found = definition(line)
+        # lines inside a multi-line string or signature say nothing about nesting
+        if i > signature_end and line[0][0] not in String:
+            # code at or left of a definition's indent closes it
+            while stack and indent <= stack[-1][0]:
+                stack.pop()
+        if found is None:
+            continue
+        kind, name = found
+        if stack and stack[-1][1] == 'function':
+            continue
+        stack.append((indent, kind))
+        signature_end = signature_end_line(lines, i)
+        start = i
+        while start > 0 and (not starts or start - 1 > starts[-1][0]) and is_preamble(significant_lines[start - 1]):
+            start -= 1
+        starts.append((start, kind, name, '\n'.join(lines[i:signature_end + 1])))
+
+    chunks = []
+    if starts and starts[0][0] > 0:
+        chunks.append({'start_line': 1, 'end_line': starts[0][0], 'kind': 'header', 'name': '', 'signature': ''})
+    for j, (start, kind, name, signature) in enumerate(starts):
+        end = starts[j + 1][0] if j + 1 < len(starts) else len(lines)
+        chunks.append({'start_line': start + 1, 'end_line': end, 'kind': kind, 'name': name,
+                       'signature': signature})
+    return chunks if len(chunks) > 1 else []
+
+
+def signature_end_line(lines, i):
+    """Index of the last line of the signature starting at lines[i]."""
+    depth = 0
+    for j in range(i, min(len(lines), i + MAX_SIGNATURE_LINES)):
+        depth += lines[j].count('(') - lines[j].count(')')
+        if depth <= 0 and not lines[j].rstrip().endswith('\\'):
+            return j
+    return i
+
+
+def chunk_text(lines, chunk):
+    return '\n'.join(lines[chunk['start_line'] - 1:chunk['end_line']])
+
+
+def chunk_stub(chunk):
+    """What stands in for a chunk left out of the context: its signature and an ellipsis."""
+    signature = chunk['signature']
+    if not signature:
+        return '...'
+    return f"{signature}\n{' ' * (indent_of(signature) + 4)}..."
+
+
+def render_chunks(content, chunks, included):
+    """Content with the chunks whose position is not in included replaced by their stubs."""
+    lines = content.split('\n')
+    return '\n'.join(chunk_text(lines, chunk) if i in included else chunk_stub(chunk)
+                     for i, chunk in enumerate(chunks))
+
+
+def planned_chunk_tokens(chunks, included, newline_tokens=1):
+    """Estimated tokens of render_chunks from the stored counts of the pieces and the newlines joining them."""
+    return sum(chunk['token_count'] if i in included else chunk['stub_tokens']
+               for i, chunk in enumerate(chunks)) + (len(chunks) - 1) * newline_tokens
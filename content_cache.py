@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from loguru import logger
+from config import Config
+from lru_eviction import evict_lru
+
+DEFAULT_MAX_ENTRIES = 500000
+
+
+def git_blob_sha(data: bytes) -> str:
+    """Returns the SHA git would assign to a blob with this content."""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def get_content_cache_path():
+    return Config.get("content_cache_path") or os.path.join(
+        Config["repos_dir"], ".cache", "content_cache.sqlite3")
+
+
+class ContentCache:
+    """Persistent cache of ingestion results keyed by content hash.
+
+    Rows are keyed by (git blob SHA, file name, token encoding) and store the
+    token count, detected language, chunk boundaries (with the chunk_min_tokens
+    they were computed for) and render mode token counts, so identical files
+    across repositories and across updates are only analysed once. The least
+    recently used rows are evicted once the cache grows past max_entries.
+    """
+
+    def __init__(self, path=None, max_entries=None):
+        self.path = path or get_content_cache_path()
+        self.max_entries = max_entries or Config.get(
+            "content_cache_max_entries", DEFAULT_MAX_ENTRIES)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # ingestion workers share the file, so wait on locks instead of failing
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS content_cache (
+                blob_sha TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                encoding TEXT NOT NULL,
+                token_count INTEGER NOT NULL,
+                language TEXT,
+                last_used REAL NOT NULL,
+                chunks TEXT,
+                mode_tokens TEXT,
+                chunk_min_tokens INTEGER,
+                PRIMARY KEY (blob_sha, file_name, encoding)
+            )""")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(content_cache)")]
+        # caches created before chunks, render modes and the chunking threshold were stored
+        for column, column_type in (('chunks', 'TEXT'), ('mode_tokens', 'TEXT'), ('chunk_min_tokens', 'INTEGER')):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE content_cache ADD COLUMN {column} {column_type}")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS content_cache_last_used ON content_cache (last_used)")
+        self.conn.commit()
+
+    def get_many(self, keys, encoding):
+        """Look up (blob_sha, file_name) keys, returning {key: (token_count, language, chunks, mode_tokens, chunk_min_tokens)}.
+
+        chunks, mode_tokens and chunk_min_tokens are None for rows written before they were cached.
+        """
+        found = {}
+        now = time.time()
+        with self.conn:
+            for blob_sha, file_name in keys:
+                row = self.conn.execute(
+                    "SELECT token_count, language, chunks, mode_tokens, chunk_min_tokens FROM content_cache WHERE blob_sha = ? AND file_name = ? AND encoding = ?",
+                    (blob_sha, file_name, encoding)).fetchone()
+                if row is not None:
+                    token_count, language, chunks, mode_tokens, chunk_min_tokens = row
+                    found[(blob_sha, file_name)] = (
+                        token_count, language,
+                        None if chunks is None else json.loads(chunks),
+                        None if mode_tokens is None else json.loads(mode_tokens),
+                        chunk_min_tokens)
+            self.conn.executemany(
+                "UPDATE content_cache SET last_used = ? WHERE blob_sha = ? AND file_name = ? AND encoding = ?",
+                [(now, blob_sha, file_name, encoding) for blob_sha, file_name in found])
+        return found
+
+    def put_many(self, entries, encoding, chunk_min_tokens):
+        """Store (blob_sha, file_name, token_count, language, chunks, mode_tokens) entries.
+
+        chunk_min_tokens is the threshold the chunks were split with.
+        """
+        if not entries:
+            return
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO content_cache"
+                " (blob_sha, file_name, encoding, token_count, language, last_used, chunks, mode_tokens, chunk_min_tokens)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(blob_sha, file_name, encoding, token_count, language, now, json.dumps(chunks), json.dumps(mode_tokens),
+                  chunk_min_tokens)
+                 for blob_sha, file_name, token_count, language, chunks, mode_tokens in entries])
+        self.evict()
+
+    def evict(self):
+        evicted, _ = evict_lru(self.conn, "content_cache", self.max_entries)
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from content cache {self.path}")
+        return evicted
+
+    def close(self):
+        self.conn.close()
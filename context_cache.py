@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+from loguru import logger
+from config import Config
+
+DEFAULT_MAX_CHARS = 50_000_000
+
+
+class ContextCache:
+    """In-memory LRU cache of assembled contexts and related selection results.
+
+    Entries are keyed by repository path plus everything that affects the
+    cached value, and the cache is bounded by the total size the callers report
+    for the values (characters, for context strings) rather than the number of
+    entries.
+    """
+
+    def __init__(self, max_chars=None):
+        self.max_chars = max_chars or Config.get(
+            "context_cache_max_chars", DEFAULT_MAX_CHARS)
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_chars:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def invalidate(self, repo_path):
+        """Drop every entry built from the given repository."""
+        with self._lock:
+            stale = [key for key in self._entries if key[0] == repo_path]
+            for key in stale:
+                self._size -= self._entries.pop(key)[1]
+        if stale:
+            logger.info(
+                f"Invalidated {len(stale)} cached contexts of {repo_path}")
+
+
+def make_key(repo_path, index_version, **selection):
+    """Build a hashable cache key from the repository and the selection arguments."""
+    parts = []
+    for name, value in sorted(selection.items()):
+        if isinstance(value, list):
+            value = tuple(value)
+        parts.append((name, value))
+    return (repo_path, index_version, tuple(parts))
+
+
+context_cache = ContextCache()
@@ -0,0 +1,169 @@
+import re
+import math
+from collections import Counter, namedtuple
+import numpy as np
+
+# knapsack capacity is discretized into at most this many buckets
+KNAPSACK_BUCKETS = 2000
+# only the best scoring files go through the dynamic program, the rest are packed greedily
+KNAPSACK_MAX_ITEMS = 2000
+
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d+')
+_CAMEL_PART = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+
+PackResult = namedtuple("PackResult", ["selected", "dropped"])
+
+
+def tokenize_text(text):
+    """Split text into lower-cased search terms.
+
+    Identifiers are kept whole and also split on underscores and camel case, so
+    "getRepoStats" matches questions about "repo stats".
+    """
+    terms = []
+    for identifier in _IDENTIFIER.findall(text):
+        lowered = identifier.lower()
+        terms.append(lowered)
+        parts = [part.lower() for chunk in identifier.split('_')
+                 for part in _CAMEL_PART.findall(chunk)]
+        if len(parts) > 1:
+            terms.extend(parts)
+    return [term for term in terms if len(term) > 1]
+
+
+class BM25:
+    """Okapi BM25 of documents given as term counts and lengths.
+
+    The corpus statistics (document count, average length and document
+    frequencies) may come from a larger corpus than the scored documents, such
+    as the ranking terms kept by search_index.SearchIndex; from_documents
+    computes them from term lists instead.
+    """
+
+    def __init__(self, term_frequencies, lengths, document_count, average_length, document_frequency, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = term_frequencies
+        self.lengths = np.array(lengths, dtype=float)
+        self.average_length = average_length
+        self.idf = {term: math.log(1 + (document_count - df + 0.5) / (df + 0.5))
+                    for term, df in document_frequency.items()}
+
+    @classmethod
+    def from_documents(cls, documents, k1=1.5, b=0.75):
+        term_frequencies = [Counter(document) for document in documents]
+        lengths = [len(document) for document in documents]
+        document_frequency = Counter()
+        for frequencies in term_frequencies:
+            document_frequency.update(frequencies.keys())
+        average_length = sum(lengths) / len(lengths) if lengths else 0.0
+        return cls(term_frequencies, lengths, len(documents), average_length, document_frequency, k1, b)
+
+    def scores(self, query_terms):
+        scores = np.zeros(len(self.term_frequencies))
+        if not self.average_length:
+            return scores
+        norms = self.k1 * (1 - self.b + self.b * self.lengths / self.average_length)
+        for term in set(query_terms):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            tf = np.array([frequencies.get(term, 0) for frequencies in self.term_frequencies], dtype=float)
+            scores += idf * tf * (self.k1 + 1) / (tf + norms)
+        return scores
+
+
+def select_knapsack(scores, weights, capacity):
+    """Indices maximizing the total score with total weight <= capacity (0/1 knapsack).
+
+    Weights are rounded up to capacity / KNAPSACK_BUCKETS, so the answer never
+    exceeds the capacity but may leave a little of it unused.
+    """
+    n = len(weights)
+    if n == 0 or capacity <= 0:
+        return []
+    unit = max(1, math.ceil(capacity / KNAPSACK_BUCKETS))
+    buckets = capacity // unit
+    bucket_weights = [math.ceil(weight / unit) for weight in weights]
+
+    best = np.zeros(buckets + 1)
+    taken = np.zeros((n, buckets + 1), dtype=bool)
+    for i, (score, weight) in enumerate(zip(scores, bucket_weights)):
+        if weight > buckets or score <= 0:
+            continue
+        candidate = np.full(buckets + 1, -np.inf)
+        candidate[weight:] = best[:buckets + 1 - weight] + score
+        taken[i] = candidate > best
+        best = np.where(taken[i], candidate, best)
+
+    selected = []
+    remaining = buckets
+    for i in range(n - 1, -1, -1):
+        if taken[i, remaining]:
+            selected.append(i)
+            remaining -= bucket_weights[i]
+    return selected[::-1]
+
+
+def pack_files(df, scores, weights, capacity):
+    """Choose the rows of df to fit in capacity tokens, favouring the relevant ones.
+
+    scores holds the relevance of each row, usually BM25 of the question against
+    the path and content of the file. Files with a positive score are packed with a knapsack over their token
+    weights; leftover room is then filled greedily, best score first and the
+    original order among unscored files. Returns a PackResult whose frames keep
+    the original row order, with a 'relevance' column added.
+    """
+    scores = np.asarray(scores, dtype=float)
+    weights = [int(weight) for weight in weights]
+
+    candidates = [i for i in np.argsort(-scores, kind='stable') if scores[i] > 0]
+    # highest score per token first, so the dynamic program sees the most useful files
+    candidates.sort(key=lambda i: scores[i] / max(weights[i], 1), reverse=True)
+    knapsack_items = candidates[:KNAPSACK_MAX_ITEMS]
+    chosen = {knapsack_items[j] for j in select_knapsack(
+        [scores[i] for i in knapsack_items], [weights[i] for i in knapsack_items], capacity)}
+
+    used = sum(weights[i] for i in chosen)
+    for i in np.argsort(-scores, kind='stable'):
+        if i not in chosen and used + weights[i] <= capacity:
+            chosen.add(i)
+            used += weights[i]
+
+    df = df.assign(relevance=scores)
+    mask = np.zeros(len(df), dtype=bool)
+    mask[list(chosen)] = True
+    return PackResult(selected=df[mask], dropped=df[~mask])
+
+
+def pack_chunks(units, scores, weights, file_costs, capacity):
+    """Choose the rows of units (chunks, or whole files) to fit in capacity tokens.
+
+    Including the first unit of a file also pays file_costs[file_path], the
+    wrapper and stubs of that file. Units with scores as in pack_files are taken
+    greedily, best score per token first and then the unscored ones in their
+    original order, skipping any that no longer fit. A knapsack does not apply
+    here because of the shared per-file cost. Returns a PackResult over units
+    with a 'relevance' column added.
+    """
+    scores = np.asarray(scores, dtype=float)
+    weights = [max(0, int(weight)) for weight in weights]
+
+    scored = sorted((i for i in range(len(units)) if scores[i] > 0),
+                    key=lambda i: scores[i] / max(weights[i], 1), reverse=True)
+    unscored = [i for i in range(len(units)) if scores[i] <= 0]
+
+    chosen = set()
+    opened = set()
+    used = 0
+    for i, file_path in ((i, units['file_path'].iat[i]) for i in scored + unscored):
+        cost = weights[i] + (0 if file_path in opened else int(file_costs[file_path]))
+        if used + cost <= capacity:
+            chosen.add(i)
+            opened.add(file_path)
+            used += cost
+
+    units = units.assign(relevance=scores)
+    mask = np.zeros(len(units), dtype=bool)
+    mask[list(chosen)] = True
+    return PackResult(selected=units[mask], dropped=units[~mask])
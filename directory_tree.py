@@ -0,0 +1,98 @@
+import os
+import json
+
+
+def _new_dir():
+    return {"files": 0, "tokens": 0, "languages": {}, "children": {}}
+
+
+class DirectoryTree:
+    """Directory tree of the indexed files with per-directory aggregates.
+
+    Directory nodes hold the number of files, the total token count and a file
+    count per language for everything beneath them; file nodes hold their own
+    token count and language. The tree is built once when the index is written
+    and subsets are rendered by pruning it instead of rebuilding a tree.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def from_files(cls, df):
+        root = _new_dir()
+        for file_path, token_count, language in zip(df['file_path'], df['token_count'], df['language']):
+            token_count = int(token_count) if token_count == token_count else 0  # NaN check
+            language = language if isinstance(language, str) else None
+            parts = file_path.replace('\\', '/').split('/')
+            node = root
+            for part in parts[:-1]:
+                _add_to_dir(node, token_count, language)
+                node = node["children"].setdefault(part, _new_dir())
+            _add_to_dir(node, token_count, language)
+            node["children"][parts[-1]] = {"tokens": token_count, "language": language}
+        return cls(root)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.root, f)
+        os.replace(tmp_path, path)
+
+    def node(self, folder):
+        """Return the node of a folder path ('' is the root), or None if it does not exist."""
+        node = self.root
+        for part in [part for part in folder.replace('\\', '/').split('/') if part]:
+            node = node.get("children", {}).get(part)
+            if node is None or "children" not in node:
+                return None
+        return node
+
+    def folder_stats(self):
+        """Map every folder path to its (file count, token count)."""
+        stats = {}
+
+        def visit(node, path):
+            stats[path] = (node["files"], node["tokens"])
+            for name, child in node["children"].items():
+                if "children" in child:
+                    visit(child, f"{path}/{name}" if path else name)
+
+        visit(self.root, '')
+        return stats
+
+    def render_lines(self, file_paths=None):
+        """Indented lines of the tree, pruned to file_paths and their parent folders if given."""
+        keep = None
+        if file_paths is not None:
+            keep = set()
+            for file_path in file_paths:
+                parts = file_path.replace('\\', '/').split('/')
+                for depth in range(1, len(parts) + 1):
+                    keep.add('/'.join(parts[:depth]))
+
+        lines = []
+
+        def visit(node, path, prefix):
+            for name, child in node["children"].items():
+                child_path = f"{path}/{name}" if path else name
+                if keep is not None and child_path not in keep:
+                    continue
+                lines.append(prefix + name)
+                if "children" in child:
+                    visit(child, child_path, prefix + '  ')
+
+        visit(self.root, '', '')
+        return lines
+
+
+def _add_to_dir(node, token_count, language):
+    node["files"] += 1
+    node["tokens"] += token_count
+    if language:
+        node["languages"][language] = node["languages"].get(language, 0) + 1
@@ -0,0 +1,166 @@
+import os
+import re
+from config import Config
+
+IGNORED_DIRS = {'.git'}
+BINARY_SNIFF_SIZE = 8192
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+
+
+def normalize_path(path):
+    return path.replace('\\', '/').strip('/')
+
+
+def get_max_file_size():
+    return Config.get("max_file_size", DEFAULT_MAX_FILE_SIZE)
+
+
+def is_binary(data: bytes) -> bool:
+    """Git's heuristic: a NUL byte in the first block means the file is binary."""
+    return b'\0' in data[:BINARY_SNIFF_SIZE]
+
+
+def _glob_to_regex(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(pattern[i])
+                i += 1
+            else:
+                regex += '[' + pattern[i + 1:end].replace('\\', '\\\\') + ']'
+                i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+def glob_regex(pattern):
+    """Regex source matching a whole relative path against a gitignore-style glob.
+
+    * and ? stay within one path segment, ** spans directories, and a pattern
+    without a slash (other than a trailing one) matches at any depth.
+    """
+    anchored = '/' in pattern.rstrip('/')
+    pattern = pattern.strip('/')
+    return ('^' if anchored else '^(?:.*/)?') + _glob_to_regex(pattern) + '$'
+
+
+class IgnoreRule:
+    """A single .gitignore-style pattern, relative to the directory it was defined in."""
+
+    def __init__(self, pattern, base=''):
+        self.base = normalize_path(base)
+        self.negate = pattern.startswith('!')
+        if self.negate:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        # a slash anywhere but at the end anchors the pattern to its base directory
+        self.regex = re.compile(glob_regex(pattern))
+
+    def matches(self, rel_path, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        if self.base:
+            if not rel_path.startswith(self.base + '/'):
+                return False
+            rel_path = rel_path[len(self.base) + 1:]
+        return self.regex.match(rel_path) is not None
+
+
+def parse_ignore_lines(lines, base=''):
+    rules = []
+    for line in lines:
+        line = line.rstrip('\n').rstrip()
+        if not line or line.startswith('#'):
+            continue
+        rules.append(IgnoreRule(line, base))
+    return rules
+
+
+class FileFilter:
+    """Decides which files of a repository are ingested.
+
+    Paths are relative to the repository root and may use either separator. Rules
+    come from the ignore_patterns list in config.yaml and, when root is given, from
+    the .gitignore files found in the tree, which are loaded lazily per directory.
+    Both the directory walk of get_repo_stats and archive extraction consult it, so
+    excluded files are never written to disk or read.
+    """
+
+    def __init__(self, root=None, ignore_patterns=None):
+        self.root = root
+        if ignore_patterns is None:
+            ignore_patterns = Config.get("ignore_patterns") or []
+        self.config_rules = parse_ignore_lines(ignore_patterns)
+        self.max_file_size = get_max_file_size()
+        self._gitignore_rules = {}  # directory -> rules of its .gitignore
+
+    def _rules_for(self, rel_dir):
+        if self.root is None:
+            return []
+        if rel_dir not in self._gitignore_rules:
+            gitignore_path = os.path.join(self.root, rel_dir, '.gitignore')
+            rules = []
+            if os.path.isfile(gitignore_path):
+                with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+                    rules = parse_ignore_lines(f, base=rel_dir)
+            self._gitignore_rules[rel_dir] = rules
+        return self._gitignore_rules[rel_dir]
+
+    def _matching_reason(self, rel_path, is_dir):
+        # later rules override earlier ones, and deeper .gitignore files override shallower ones
+        reason = None
+        for rule in self.config_rules:
+            if rule.matches(rel_path, is_dir):
+                reason = None if rule.negate else 'ignore pattern'
+        parts = rel_path.split('/')
+        for depth in range(len(parts)):
+            for rule in self._rules_for('/'.join(parts[:depth])):
+                if rule.matches(rel_path, is_dir):
+                    reason = None if rule.negate else 'gitignore'
+        return reason
+
+    def dir_exclusion_reason(self, rel_dir):
+        rel_dir = normalize_path(rel_dir)
+        if rel_dir.split('/')[-1] in IGNORED_DIRS:
+            return 'ignored directory'
+        return self._matching_reason(rel_dir, is_dir=True)
+
+    def is_excluded_dir(self, rel_dir):
+        return self.dir_exclusion_reason(rel_dir) is not None
+
+    def exclusion_reason(self, rel_path, size=None, check_parents=True):
+        """Returns why rel_path is excluded, or None if it should be ingested.
+
+        Ancestor directories are checked too unless check_parents is False, which
+        a directory walk that already pruned excluded directories can pass.
+        """
+        rel_path = normalize_path(rel_path)
+        if check_parents:
+            parts = rel_path.split('/')
+            for depth in range(1, len(parts)):
+                if self.is_excluded_dir('/'.join(parts[:depth])):
+                    return 'ignored directory'
+        reason = self._matching_reason(rel_path, is_dir=False)
+        if reason is None and size is not None and self.max_file_size and size > self.max_file_size:
+            reason = 'too large'
+        return reason
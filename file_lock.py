@@ -0,0 +1,26 @@
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no advisory locks, processes are not coordinated
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive advisory lock on path (created if missing) across processes.
+
+    Locks are taken per open file, so threads of one process exclude each
+    other too. Blocks until the lock is free.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
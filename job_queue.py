@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from loguru import logger
+from config import Config
+
+DEFAULT_WORKERS = 2
+# progress is written at most this often per job, plus on every stage change
+PROGRESS_INTERVAL = 0.5
+
+
+def get_job_queue_path():
+    return Config.get("job_queue_path") or os.path.join(
+        Config["repos_dir"], ".cache", "jobs.sqlite3")
+
+
+class JobQueue:
+    """Persistent queue of repository jobs run by a pool of worker threads.
+
+    Jobs are rows of a SQLite table holding their kind, repository url,
+    parameters, status and progress, so the UI can poll them from any session.
+    Submitting a job while the same kind of job is queued or running for the
+    repository returns the existing job, and jobs of one repository never run
+    concurrently. Jobs still queued or running when the process stopped are
+    queued again by start(), so runners must be safe to repeat.
+
+    runner is called as runner(kind, repo_url, params, progress) where
+    progress(stage, done, total) reports progress; it returns False or raises
+    when the job fails.
+    """
+
+    def __init__(self, runner, path=None, workers=None):
+        self.runner = runner
+        self.path = path or get_job_queue_path()
+        self.workers = workers or Config.get("job_workers", DEFAULT_WORKERS)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                repo_url TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                done INTEGER,
+                total INTEGER,
+                error TEXT,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL
+            )""")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        self.conn.commit()
+        self.threads = []
+
+    def start(self):
+        """Start the worker threads, which pick up jobs left over from a previous run too."""
+        if self.threads:
+            return
+        with self.lock, self.conn:
+            requeued = self.conn.execute(
+                "UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'").rowcount
+        if requeued:
+            logger.info(f"Re-queued {requeued} job(s) interrupted by a restart")
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, kind, repo_url, **params):
+        """Queue a job, returning its id, or the id of the matching job already queued or running."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND repo_url = ? AND status IN ('queued', 'running')",
+                (kind, repo_url)).fetchone()
+            if row is not None:
+                logger.info(f"Job {kind} for {repo_url} is already pending as job {row[0]}")
+                return row[0]
+            with self.conn:
+                job_id = self.conn.execute(
+                    "INSERT INTO jobs (kind, repo_url, params, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                    (kind, repo_url, json.dumps(params), time.time())).lastrowid
+            self.wakeup.notify()
+        logger.info(f"Queued job {job_id}: {kind} {repo_url}")
+        return job_id
+
+    def get(self, job_id):
+        with self.lock:
+            jobs = self._rows(self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)))
+        return jobs[0] if jobs else None
+
+    def active_jobs(self, repo_url=None):
+        """Queued and running jobs, oldest first, optionally of one repository."""
+        query = "SELECT * FROM jobs WHERE status IN ('queued', 'running')"
+        args = ()
+        if repo_url is not None:
+            query += " AND repo_url = ?"
+            args = (repo_url,)
+        with self.lock:
+            return self._rows(self.conn.execute(query + " ORDER BY id", args))
+
+    def recent_jobs(self, limit=20):
+        with self.lock:
+            return self._rows(self.conn.execute(
+                "SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)))
+
+    @staticmethod
+    def _rows(cursor):
+        columns = [column[0] for column in cursor.description]
+        jobs = []
+        for row in cursor.fetchall():
+            job = dict(zip(columns, row))
+            job['params'] = json.loads(job['params'])
+            jobs.append(job)
+        return jobs
+
+    def _claim(self):
+        """Mark the oldest queued job whose repository has no running job as running and return it."""
+        jobs = self._rows(self.conn.execute("""
+            SELECT * FROM jobs WHERE status = 'queued' AND repo_url NOT IN (
+                SELECT repo_url FROM jobs WHERE status = 'running')
+            ORDER BY id LIMIT 1"""))
+        if not jobs:
+            return None
+        job = jobs[0]
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), job['id']))
+        return job
+
+    def _work(self):
+        while True:
+            with self.lock:
+                job = self._claim()
+                while job is None:
+                    self.wakeup.wait()
+                    job = self._claim()
+            self._run(job)
+
+    def _run(self, job):
+        logger.info(f"Running job {job['id']}: {job['kind']} {job['repo_url']}")
+        last_report = [None, 0.0]
+
+        def progress(stage, done, total):
+            now = time.monotonic()
+            if stage == last_report[0] and done != total and now - last_report[1] < PROGRESS_INTERVAL:
+                return
+            last_report[:] = [stage, now]
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "UPDATE jobs SET stage = ?, done = ?, total = ? WHERE id = ?", (stage, done, total, job['id']))
+
+        error = None
+        try:
+            if self.runner(job['kind'], job['repo_url'], job['params'], progress) is False:
+                error = f"{job['kind']} failed"
+        except Exception as e:
+            logger.exception(f"Job {job['id']} failed")
+            error = str(e) or type(e).__name__
+        status = 'failed' if error else 'done'
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                    (status, error, time.time(), job['id']))
+            # jobs of this repository that waited for it can run now
+            self.wakeup.notify_all()
+        logger.info(f"Job {job['id']} {status}")
+
+    def close(self):
+        self.conn.close()
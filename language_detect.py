@@ -0,0 +1,71 @@
+import os
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from pygments.lexers import get_all_lexers, guess_lexer_for_filename
+from pygments.lexers.special import TextLexer
+from pygments.util import ClassNotFound
+
+# content-based guessing only looks at this many leading characters
+GUESS_PREFIX_SIZE = 8192
+
+_GLOB_CHARS = set('*?[')
+
+
+@lru_cache(maxsize=None)
+def get_language_table():
+    """Build (by_filename, by_extension, glob_patterns) once from Pygments' lexer registry.
+
+    by_filename maps exact file names (e.g. "Makefile") and by_extension maps
+    suffixes (e.g. ".py", ".cmake.in") to the set of lexer names declaring them.
+    Patterns that are neither are kept as (pattern, name) pairs for fnmatch.
+    """
+    by_filename, by_extension, glob_patterns = {}, {}, []
+    for name, _, filenames, _ in get_all_lexers():
+        for pattern in filenames:
+            if pattern.startswith('*.') and not _GLOB_CHARS & set(pattern[2:]):
+                by_extension.setdefault(pattern[1:], set()).add(name)
+            elif not _GLOB_CHARS & set(pattern):
+                by_filename.setdefault(pattern, set()).add(name)
+            else:
+                glob_patterns.append((pattern, name))
+    return by_filename, by_extension, glob_patterns
+
+
+def candidate_languages(file_name):
+    """Names of the lexers whose filename patterns match file_name."""
+    by_filename, by_extension, glob_patterns = get_language_table()
+    candidates = set(by_filename.get(file_name, ()))
+    # "*.ext" also matches multi-dot suffixes and dotfiles, so try every suffix
+    dot = file_name.find('.')
+    while dot != -1:
+        candidates |= by_extension.get(file_name[dot:], set())
+        dot = file_name.find('.', dot + 1)
+    for pattern, name in glob_patterns:
+        if fnmatchcase(file_name, pattern):
+            candidates.add(name)
+    return candidates
+
+
+def guess_language(file_path, content):
+    """The previous approach: let Pygments score every lexer matching the name against the content."""
+    try:
+        lexer = guess_lexer_for_filename(file_path, content)
+    except ClassNotFound:
+        return None
+    if isinstance(lexer, TextLexer):
+        return None
+    return lexer.name
+
+
+def detect_language(file_path, content):
+    """Detect the language of a file from its name, looking at content only when needed.
+
+    A name claimed by exactly one lexer is resolved from the precomputed table.
+    Ambiguous names (e.g. ".h") and names no lexer claims fall back to Pygments'
+    content-based guess on the first GUESS_PREFIX_SIZE characters.
+    """
+    candidates = candidate_languages(os.path.basename(file_path))
+    if len(candidates) == 1:
+        language = next(iter(candidates))
+        return None if language == TextLexer.name else language
+    return guess_language(file_path, content[:GUESS_PREFIX_SIZE])
@@ -1,7 +1,14 @@
 import os
+import random
+import asyncio
+import threading
 from enum import Enum
+import httpx
+import openai
 from loguru import logger
-from openai import OpenAI
+from openai import AsyncOpenAI
+from config import Config
+from response_cache import get_response_cache, response_key
 
 class ProviderType(str, Enum):
     OPENAI = "OPENAI"
@@ -61,20 +68,305 @@ def get_api_key(selected_model: str) -> str:
         raise ValueError(f"Model {selected_model} not found.")
 
 
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+_loop = None
+_loop_lock = threading.Lock()
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Get the process-wide event loop that runs all LLM requests.
+
+    The loop runs in a daemon thread, so pooled connections are shared by every
+    Streamlit session (each of which runs in its own thread without a loop).
+
+    Returns:
+        asyncio.AbstractEventLoop: the running background loop
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="llm-event-loop", daemon=True
+            ).start()
+    return _loop
+
+
+class _Pool:
+    """Pooled HTTP client and concurrency limit shared by all requests to one base url."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                Config.get("llm_timeout", 600),
+                connect=Config.get("llm_connect_timeout", 10),
+            ),
+            limits=httpx.Limits(
+                max_connections=Config.get("llm_max_connections", 20),
+                max_keepalive_connections=Config.get("llm_max_connections", 20),
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(Config.get("llm_max_concurrency", 8))
+        self.clients = {}
+
+    def client(self, api_key: str) -> AsyncOpenAI:
+        # one client per key, all on the same connection pool
+        if api_key not in self.clients:
+            self.clients[api_key] = AsyncOpenAI(
+                base_url=self.base_url,
+                api_key=api_key,
+                http_client=self.http_client,
+                max_retries=0,
+            )
+        return self.clients[api_key]
+
+
+def get_pool(base_url: str) -> _Pool:
+    """Get the process-wide pool of a provider base url, creating it on first use.
+
+    Args:
+        base_url(str): provider base url
+
+    Returns:
+        _Pool: pooled client and semaphore for the base url
+    """
+    with _pools_lock:
+        if base_url not in _pools:
+            _pools[base_url] = _Pool(base_url)
+        return _pools[base_url]
+
+
+def supports_prompt_caching(model: str) -> bool:
+    """Whether the model needs explicit prompt-caching breakpoints.
+
+    Anthropic models (also through OpenRouter) only cache up to a cache_control
+    marker; OpenAI models cache long prompt prefixes automatically.
+
+    Args:
+        model(str): model name
+
+    Returns:
+        bool: True if a breakpoint should be added
+    """
+    return model.startswith("anthropic/")
+
+
+def with_cache_breakpoint(messages, context_messages: int):
+    """Copy of messages with a prompt-caching breakpoint after the first context_messages.
+
+    Args:
+        messages(list): chat messages
+        context_messages(int): number of leading messages forming the stable prefix
+
+    Returns:
+        list: messages, the last prefix message using content parts with cache_control
+    """
+    if not context_messages:
+        return messages
+    messages = list(messages)
+    message = dict(messages[context_messages - 1])
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = [dict(part) for part in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    message["content"] = content
+    messages[context_messages - 1] = message
+    return messages
+
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """Seconds to wait before retrying, honouring a Retry-After header."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), Config.get("llm_max_retry_delay", 60))
+        except ValueError:
+            pass
+    base = Config.get("llm_retry_backoff", 1.0)
+    return min(base * 2 ** attempt, Config.get("llm_max_retry_delay", 60)) * (0.5 + random.random() / 2)
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRY_STATUS_CODES
+
+
+class AsyncChatClient:
+    """Chat client on the pooled connections of its base url.
+
+    At most llm_max_concurrency requests per base url run at once, and failed
+    requests are retried with exponential backoff on connection errors,
+    timeouts, 429 and 5xx responses. A streamed request is only retried until
+    its first chunk arrives.
+    """
+
+    def __init__(self, base_url: str, api_key: str):
+        self.base_url = base_url
+        self.api_key = api_key
+
+    async def _create(self, **kwargs):
+        pool = get_pool(self.base_url)
+        max_retries = Config.get("llm_max_retries", 3)
+        attempt = 0
+        while True:
+            try:
+                return await pool.client(self.api_key).chat.completions.create(**kwargs)
+            except openai.APIError as e:
+                if attempt >= max_retries or not _is_retryable(e):
+                    raise
+                delay = _retry_delay(attempt, e)
+                attempt += 1
+                logger.warning(
+                    f"LLM request to {self.base_url} failed ({e.__class__.__name__}), retrying in {delay:.1f}s ({attempt}/{max_retries})")
+                await asyncio.sleep(delay)
+
+    async def chat(
+        self, messages, model="anthropic/claude-3-opus", temperature=0.7, context_messages=0
+    ):
+        """Send a chat completion request and return the completion.
+
+        Args:
+            messages(list): chat messages
+            model(str): model name
+            temperature(float): sampling temperature
+            context_messages(int): leading messages that repeat across requests (system
+                prompt, repo context), marked for prompt caching where supported
+
+        Returns:
+            ChatCompletion: the completion
+        """
+        if supports_prompt_caching(model):
+            messages = with_cache_breakpoint(messages, context_messages)
+        async with get_pool(self.base_url).semaphore:
+            return await self._create(
+                model=model, messages=messages, temperature=temperature, stream=False
+            )
+
+    async def stream(
+        self, messages, model="anthropic/claude-3-opus", temperature=0.7, context_messages=0
+    ):
+        """Send a streamed chat completion request and yield its chunks.
+
+        Args:
+            messages(list): chat messages
+            model(str): model name
+            temperature(float): sampling temperature
+            context_messages(int): see chat
+
+        Yields:
+            ChatCompletionChunk: the streamed chunks
+        """
+        if supports_prompt_caching(model):
+            messages = with_cache_breakpoint(messages, context_messages)
+        async with get_pool(self.base_url).semaphore:
+            response = await self._create(
+                model=model, messages=messages, temperature=temperature, stream=True
+            )
+            try:
+                async for chunk in response:
+                    yield chunk
+            finally:
+                await response.close()
+
+
+class TextStream:
+    """Iterable of the text deltas of a reply.
+
+    cached is True when the reply comes from the response cache instead of the provider.
+    """
+
+    def __init__(self, deltas, cached=False):
+        self.deltas = deltas
+        self.cached = cached
+
+    def __iter__(self):
+        return iter(self.deltas)
+
+
 class ChatClient:
+    """Synchronous facade of AsyncChatClient, running it on the shared event loop."""
+
     def __init__(self, base_url: str, api_key: str):
         logger.info(
             f"Initializing ChatClient, base_url: {base_url} and api_key: {api_key[:5]}..."
         )
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        self.async_client = AsyncChatClient(base_url, api_key)
 
     def chat(
-        self, messages, model="anthropic/claude-3-opus", temperature=0.7, stream=True
+        self, messages, model="anthropic/claude-3-opus", temperature=0.7, stream=True, context_messages=0
     ):
-        return self.client.chat.completions.create(
-            model=model, messages=messages, stream=stream, temperature=temperature
+        loop = get_event_loop()
+        if not stream:
+            return asyncio.run_coroutine_threadsafe(
+                self.async_client.chat(
+                    messages, model=model, temperature=temperature, context_messages=context_messages), loop
+            ).result()
+        return _iterate(
+            self.async_client.stream(
+                messages, model=model, temperature=temperature, context_messages=context_messages), loop
         )
 
+    def stream_text(
+        self, messages, model="anthropic/claude-3-opus", temperature=0.7, context_messages=0
+    ):
+        """Stream the reply as text deltas.
+
+        Temperature 0 replies are stored in the response cache once complete and
+        later identical requests are answered from it in a single delta.
+
+        Args:
+            messages(list): chat messages
+            model(str): model name
+            temperature(float): sampling temperature
+            context_messages(int): see AsyncChatClient.chat
+
+        Returns:
+            TextStream: text deltas of the reply, flagged when answered from the cache
+        """
+        cache = key = None
+        if temperature == 0 and Config.get("response_cache", True):
+            cache = get_response_cache()
+            key = response_key(model, temperature, messages, context_messages)
+            cached = cache.get(key)
+            if cached is not None:
+                logger.info(f"Answered from response cache: {key[:12]}")
+                return TextStream([cached], cached=True)
+        return TextStream(self._stream_deltas(messages, model, temperature, context_messages, cache, key))
+
+    def _stream_deltas(self, messages, model, temperature, context_messages, cache, key):
+        parts = []
+        for chunk in self.chat(
+            messages, model=model, temperature=temperature, stream=True, context_messages=context_messages
+        ):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+        # only complete replies are cached, an interrupted stream never gets here
+        if cache is not None:
+            cache.put(key, "".join(parts))
+
+
+def _iterate(async_iterator, loop):
+    """Iterate an async iterator running on loop from a synchronous thread."""
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(async_iterator.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        # runs on early exit too, releasing the connection and the semaphore
+        asyncio.run_coroutine_threadsafe(async_iterator.aclose(), loop).result()
+
 
 def create_client_for_model(selected_model: str):
     """Create a client for the selected model.
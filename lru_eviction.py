@@ -0,0 +1,21 @@
+def evict_lru(conn, table, limit, size="1"):
+    """Delete the least recently used rows of a SQLite table once their total size passes limit.
+
+    Rows are ordered by their last_used column and weigh the SQL expression size,
+    so the default bounds the number of rows. Returns (rows evicted, size freed).
+    """
+    total = conn.execute(f"SELECT COALESCE(SUM({size}), 0) FROM {table}").fetchone()[0]
+    if total <= limit:
+        return 0, 0
+    # evict down to 90% so that eviction does not run on every insert
+    target = total - int(limit * 0.9)
+    freed = 0
+    rowids = []
+    for rowid, row_size in conn.execute(f"SELECT rowid, {size} FROM {table} ORDER BY last_used"):
+        rowids.append((rowid,))
+        freed += row_size
+        if freed >= target:
+            break
+    with conn:
+        conn.executemany(f"DELETE FROM {table} WHERE rowid = ?", rowids)
+    return len(rowids), freed
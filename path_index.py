@@ -0,0 +1,95 @@
+import re
+import numpy as np
+import pandas as pd
+from file_filter import glob_regex
+
+# sorts after every character that can appear in a path, closing a prefix range
+_PREFIX_END = '\U0010ffff'
+
+
+def path_key(path):
+    """Normalized form used to match selections: forward slashes, lower case."""
+    return path.replace('\\', '/').strip('/').lower()
+
+
+def path_keys(paths: pd.Series) -> pd.Series:
+    return paths.str.replace('\\', '/', regex=False).str.strip('/').str.lower()
+
+
+class PathIndex:
+    """Resolves file, folder, language, glob and regex selections to row positions.
+
+    Keys are kept sorted, so every folder is a contiguous range of the sorted keys
+    found with two binary searches, i.e. a flattened directory trie. Files are
+    found the same way and languages through a precomputed position list, so only
+    glob and regex selectors have to look at every path.
+    """
+
+    def __init__(self, df):
+        keys = df['path_key'].to_numpy(dtype=object)
+        self.size = len(keys)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+        self.keys = keys
+        self.language_positions = {
+            language: np.asarray(positions)
+            for language, positions in df.reset_index(drop=True).groupby('language').indices.items()
+        }
+
+    def _range(self, lo_key, hi_key):
+        lo = np.searchsorted(self.sorted_keys, lo_key, side='left')
+        hi = np.searchsorted(self.sorted_keys, hi_key, side='right')
+        return self.order[lo:hi]
+
+    def files(self, paths):
+        return [self._range(key, key) for key in map(path_key, paths)]
+
+    def folders(self, folders):
+        ranges = []
+        for key in map(path_key, folders):
+            if not key:
+                # the repository root contains everything
+                ranges.append(np.arange(self.size))
+            else:
+                ranges.append(self._range(key + '/', key + '/' + _PREFIX_END))
+        return ranges
+
+    def globs(self, patterns):
+        # same semantics as .gitignore patterns: * stops at '/', ** crosses directories
+        regexes = [f'(?:{glob_regex(path_key(pattern))})' for pattern in patterns]
+        return self._matching(re.compile('|'.join(regexes)))
+
+    def patterns(self, patterns):
+        regex = re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE)
+        return self._matching(regex, search=True)
+
+    def _matching(self, regex, search=False):
+        matcher = regex.search if search else regex.match
+        mask = np.fromiter((matcher(key) is not None for key in self.keys),
+                           dtype=bool, count=self.size)
+        return [np.flatnonzero(mask)]
+
+    def select(self, selected_files=None, selected_folders=None, selected_languages=None,
+               selected_globs=None, selected_patterns=None):
+        """Sorted row positions matching any path selector and, if given, one of the languages."""
+        ranges = []
+        if selected_files:
+            ranges += self.files(selected_files)
+        if selected_folders:
+            ranges += self.folders(selected_folders)
+        if selected_globs:
+            ranges += self.globs(selected_globs)
+        if selected_patterns:
+            ranges += self.patterns(selected_patterns)
+        if not ranges:
+            return np.array([], dtype=np.intp)
+        positions = np.unique(np.concatenate(ranges))
+
+        if selected_languages:
+            language_positions = [self.language_positions[language]
+                                  for language in selected_languages if language in self.language_positions]
+            if not language_positions:
+                return np.array([], dtype=np.intp)
+            positions = np.intersect1d(
+                positions, np.concatenate(language_positions), assume_unique=False)
+        return positions
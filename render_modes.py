@@ -0,0 +1,118 @@
+import re
+from pygments.token import Comment, Keyword, String, Text
+from chunking import definition, is_preamble, lex, line_tokens, signature_end_line
+
+RENDER_MODES = ('full', 'no_comments', 'compact', 'outline')
+# metadata column holding the token count of a file rendered in each mode
+MODE_TOKEN_COLUMNS = {
+    'full': 'token_count',
+    'no_comments': 'token_count_no_comments',
+    'compact': 'token_count_compact',
+    'outline': 'token_count_outline',
+}
+# modes counted at ingestion besides 'full', whose count is token_count itself
+COMPRESSED_MODES = RENDER_MODES[1:]
+COMPRESSED_TOKEN_COLUMNS = [MODE_TOKEN_COLUMNS[mode] for mode in COMPRESSED_MODES]
+IMPORT_KEYWORDS = {'import', 'from', 'use', 'using', 'require', 'package', 'include', 'mod'}
+# prose and data formats have no definitions to outline, 'outline' keeps them as in 'no_comments'
+UNOUTLINED_LANGUAGES = {'Markdown', 'reStructuredText', 'Text only', 'TeX', 'HTML', 'XML',
+                        'JSON', 'JSON5', 'YAML', 'TOML', 'INI', 'Properties'}
+# bumped whenever a mode renders differently, so that counts stored by older versions are redone
+RENDER_VERSION = 2
+
+_SPACES = re.compile(r'[ \t]+')
+
+
+def _is_comment(ttype):
+    # preprocessor lines such as #include are lexed as comments but are code
+    return ttype in Comment and ttype not in Comment.Preproc and ttype not in Comment.PreprocFile
+
+
+def _drop_blank_lines(text):
+    return '\n'.join(line.rstrip() for line in text.split('\n') if line.strip())
+
+
+def _collapse(line):
+    stripped = line.lstrip()
+    return line[:len(line) - len(stripped)] + _SPACES.sub(' ', stripped)
+
+
+def strip_comments(tokens, collapse=False):
+    """Source from a token stream without comments and blank lines.
+
+    With collapse, runs of spaces between tokens shrink to one; indentation and
+    string literals are left alone.
+    """
+    pieces = []
+    at_line_start = True
+    for ttype, value in tokens:
+        if _is_comment(ttype):
+            continue
+        if collapse and ttype in Text:
+            parts = value.split('\n')
+            if not at_line_start:
+                parts[0] = _SPACES.sub(' ', parts[0])
+            value = '\n'.join(parts)
+        pieces.append(value)
+        if '\n' in value:
+            at_line_start = not value.rsplit('\n', 1)[1].strip()
+        else:
+            at_line_start = at_line_start and not value.strip()
+    return _drop_blank_lines(''.join(pieces))
+
+
+def _is_import(line):
+    ttype, value = line[0]
+    if ttype in Comment.Preproc:
+        return any(value in ('include', 'import') for _, value in line[:3])
+    return ttype in Keyword and value in IMPORT_KEYWORDS
+
+
+def outline(content, tokens):
+    """Imports, definition signatures with their doc comments or decorators, and docstrings."""
+    lines = content.split('\n')
+    significant_lines = line_tokens(tokens)[:len(lines)]
+    keep = set()
+    for i, line in enumerate(significant_lines):
+        if not line:
+            continue
+        if all(ttype in String.Doc for ttype, _ in line):
+            keep.add(i)
+        elif _is_import(line):
+            keep.update(range(i, signature_end_line(lines, i) + 1))
+        elif definition(line) is not None:
+            keep.update(range(i, signature_end_line(lines, i) + 1))
+            j = i - 1
+            while j >= 0 and significant_lines[j] and is_preamble(significant_lines[j]):
+                keep.add(j)
+                j -= 1
+    return '\n'.join(lines[i].rstrip() for i in sorted(keep))
+
+
+def render(content, language, mode='full', tokens=None):
+    """Render content in one of RENDER_MODES.
+
+    'no_comments' drops comments and blank lines, 'compact' also collapses
+    whitespace and 'outline' keeps only imports, signatures and docstrings.
+    Languages without a lexer only lose blank lines (and repeated spaces in
+    'compact' and 'outline'). Files without anything to outline, such as
+    prose and data formats, are rendered as in 'no_comments' instead. tokens is
+    the chunking.lex() output if it is already at hand.
+    """
+    if mode not in RENDER_MODES:
+        raise ValueError(f"Unknown render mode: {mode}")
+    if mode == 'full' or not content:
+        return content
+    if tokens is None:
+        tokens = lex(content, language)
+    if tokens is None:
+        text = _drop_blank_lines(content)
+        if mode != 'no_comments':
+            text = '\n'.join(_collapse(line) for line in text.split('\n'))
+        return text
+    if mode == 'outline':
+        text = outline(content, tokens) if language not in UNOUTLINED_LANGUAGES else ''
+        if text.strip():
+            return text
+        mode = 'no_comments'
+    return strip_comments(tokens, collapse=mode == 'compact')
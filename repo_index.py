@@ -0,0 +1,529 @@
+import os
+import mmap
+import time
+import tempfile
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+from send2trash import send2trash
+from path_index import PathIndex, path_key, path_keys
+from directory_tree import DirectoryTree
+from search_index import SEARCH_FILE, SEARCH_VERSION, SearchIndex, search_version
+from rw_lock import ReadWriteLock
+from render_modes import COMPRESSED_TOKEN_COLUMNS, RENDER_VERSION
+
+METADATA_FILE = "repo_index.parquet"
+# indexes written before content blobs were named by generation
+CONTENT_FILE = "repo_contents.bin"
+CONTENT_FILE_PREFIX = "repo_contents."
+# parquet schema metadata key naming the content blob a metadata table points into
+CONTENT_FILE_KEY = b"content_file"
+# parquet schema metadata key holding the render_modes.RENDER_VERSION of the stored mode counts
+RENDER_VERSION_KEY = b"render_version"
+TREE_FILE = "repo_tree.json"
+CHUNKS_FILE = "repo_chunks.parquet"
+LEGACY_CSV_FILE = "repo_stats.csv"
+
+METADATA_COLUMNS = [
+    'file_name',
+    'file_path',
+    'language',
+    'line_count',
+    'file_size',
+    'token_count',
+    'token_count_no_comments',
+    'token_count_compact',
+    'token_count_outline',
+    'description',
+    'graph',
+    'blob_sha',
+    'skip_reason',
+    'path_key',
+]
+
+CHUNK_COLUMNS = [
+    'file_path',
+    'start_line',
+    'end_line',
+    'kind',
+    'name',
+    'signature',
+    'token_count',
+    'stub_tokens',
+]
+
+
+def _stat_key(path):
+    # size is part of the key so that appends within the mtime resolution are noticed
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class RepoIndex:
+    """On-disk index of a repository.
+
+    File metadata (path, language, sizes, token counts) lives in a small parquet
+    table, while file contents are concatenated into a separate UTF-8 blob. Each
+    metadata row stores the offset and length of its content in the blob, which
+    is memory-mapped so content is only sliced for the files that are used.
+    Large files also have their chunks (line ranges at definition boundaries,
+    with token counts) in a second parquet table.
+
+    A rewrite puts the contents in a new blob, named by generation, and the
+    metadata table records which blob it points into, so replacing the
+    metadata file switches readers over atomically. Callers hold lock.read()
+    while they use the index; writers only take lock.write() for the swap.
+    Use get_repo_index() to share one instance per repository in a process.
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.metadata_path = os.path.join(repo_path, METADATA_FILE)
+        self.tree_path = os.path.join(repo_path, TREE_FILE)
+        self.search_path = os.path.join(repo_path, SEARCH_FILE)
+        self.chunks_path = os.path.join(repo_path, CHUNKS_FILE)
+        self.lock = ReadWriteLock()
+        # serialises writers; readers only wait for the swap under lock.write()
+        self._write_mutex = threading.RLock()
+        # guards the lazily loaded tables below, which concurrent readers fill in
+        self._load_lock = threading.RLock()
+        self._metadata = None
+        self._files = None
+        self._path_index = None
+        self._tree = None
+        self._metadata_mtime = None
+        self._content_name = None
+        self._content_map = None
+        self._content_key = None
+        self._search = None
+        self._search_inode = None
+        self._chunks = None
+        self._chunks_mtime = None
+
+    @property
+    def content_path(self):
+        """Path of the content blob the current metadata table points into."""
+        with self._load_lock:
+            self.metadata()
+            return os.path.join(self.repo_path, self._content_name)
+
+    def _stored_content_name(self):
+        # only the parquet footer is read here
+        schema_metadata = pq.read_schema(self.metadata_path).metadata or {}
+        return schema_metadata.get(CONTENT_FILE_KEY, CONTENT_FILE.encode()).decode()
+
+    def exists(self):
+        return os.path.exists(self.metadata_path) and os.path.exists(
+            os.path.join(self.repo_path, self._stored_content_name()))
+
+    def is_empty(self):
+        if not self.exists():
+            return True
+        # only the parquet footer is read here, not the table itself
+        return pq.read_metadata(self.metadata_path).num_rows == 0
+
+    def last_modified(self):
+        return os.path.getmtime(self.metadata_path)
+
+    def version(self):
+        """Opaque value that changes whenever the index is rewritten or patched."""
+        return _stat_key(self.metadata_path)
+
+    def write(self, records):
+        """Write the index from a list of dicts holding metadata and 'file_content'."""
+        with self._write_mutex:
+            return self._write(records)
+
+    def _write(self, records):
+        os.makedirs(self.repo_path, exist_ok=True)
+        rows = []
+        chunk_rows = []
+        content_name = f"{CONTENT_FILE_PREFIX}{time.time_ns()}.bin"
+        tmp_search_path = _unique_tmp_path(self.search_path)
+        search = SearchIndex(tmp_search_path)
+        try:
+            # a new blob, so readers of the current one are not disturbed
+            with open(os.path.join(self.repo_path, content_name), "wb") as f:
+                offset = 0
+                for record in records:
+                    content = record.get('file_content')
+                    data = content.encode('utf-8') if isinstance(content, str) else b''
+                    f.write(data)
+                    if data and not record.get('skip_reason'):
+                        search.add(record['file_path'], content)
+                        if search.needs_commit():
+                            search.commit()
+                    chunk_rows += _chunk_rows(record)
+                    row = {col: record.get(col) for col in METADATA_COLUMNS}
+                    row['path_key'] = path_key(row['file_path'])
+                    row['content_offset'] = offset
+                    row['content_length'] = len(data)
+                    rows.append(row)
+                    offset += len(data)
+
+            df = pd.DataFrame(
+                rows, columns=METADATA_COLUMNS + ['content_offset', 'content_length'])
+            tmp_metadata_path = self.metadata_path + ".tmp"
+            _write_metadata(df, tmp_metadata_path, content_name)
+            tmp_chunks_path = self.chunks_path + ".tmp"
+            pd.DataFrame(chunk_rows, columns=CHUNK_COLUMNS).to_parquet(tmp_chunks_path, index=False)
+            search.commit()
+        except BaseException:
+            search.close()
+            os.remove(tmp_search_path)
+            raise
+        search.close()
+        tree = DirectoryTree.from_files(_ingested(df))
+
+        with self.lock.write():
+            self.close_search()
+            os.replace(tmp_search_path, self.search_path)
+            os.replace(tmp_chunks_path, self.chunks_path)
+            # the metadata table is replaced last: it is what points readers to the new blob
+            os.replace(tmp_metadata_path, self.metadata_path)
+            tree.save(self.tree_path)
+        self._remove_old_blobs(content_name)
+        logger.info(f"Saved repo index to {self.metadata_path}")
+        return df
+
+    def _remove_old_blobs(self, content_name):
+        """Delete content blobs older than the one before content_name.
+
+        The previous blob is kept for readers in other processes that loaded
+        the old metadata table just before the swap.
+        """
+        blobs = sorted((name for name in os.listdir(self.repo_path)
+                        if name.startswith(CONTENT_FILE_PREFIX) and name.endswith(".bin")),
+                       key=_blob_generation)
+        for name in blobs[:max(0, blobs.index(content_name) - 1)]:
+            os.remove(os.path.join(self.repo_path, name))
+
+    def patch(self, records, removed_paths=()):
+        """Replace or add the rows in records and drop removed_paths, in place.
+
+        New contents are appended to the blob and only the metadata table is
+        rewritten. Once more than half of the blob is unreferenced, the whole
+        index is rewritten to reclaim the space.
+        """
+        with self._write_mutex:
+            return self._patch(list(records), removed_paths)
+
+    def _patch(self, records, removed_paths):
+        search = self.search_index()
+        try:
+            df, blob_size = self._patch_files(search, records, removed_paths)
+        except BaseException:
+            # the search changes were only collected in memory, readers never saw them
+            search.rollback()
+            raise
+        if df['content_length'].sum() * 2 < blob_size:
+            self.compact()
+        return df
+
+    def _patch_files(self, search, records, removed_paths):
+        stale_paths = set(removed_paths) | {record['file_path'] for record in records}
+        df = self.metadata()
+        content_name = self._content_name
+        stale = df['file_path'].isin(stale_paths)
+        old = df[stale]
+        for file_path, offset, length in zip(old['file_path'], old['content_offset'], old['content_length']):
+            search.remove(file_path, self.read_content(offset, length))
+        df = df[~stale]
+        chunks = self.chunks()
+        chunks = chunks[~chunks['file_path'].isin(stale_paths)]
+
+        rows = []
+        chunk_rows = []
+        # appending leaves the offsets of the current metadata table valid
+        with open(os.path.join(self.repo_path, content_name), "ab") as f:
+            offset = f.tell()
+            for record in records:
+                content = record.get('file_content')
+                data = content.encode('utf-8') if isinstance(content, str) else b''
+                f.write(data)
+                if data and not record.get('skip_reason'):
+                    search.add(record['file_path'], content)
+                chunk_rows += _chunk_rows(record)
+                row = {col: record.get(col) for col in METADATA_COLUMNS}
+                row['path_key'] = path_key(row['file_path'])
+                row['content_offset'] = offset
+                row['content_length'] = len(data)
+                rows.append(row)
+                offset += len(data)
+
+        if rows:
+            df = pd.concat([df, pd.DataFrame(rows)], ignore_index=True)
+        else:
+            df = df.reset_index(drop=True)
+        chunks = pd.concat([chunks, pd.DataFrame(chunk_rows, columns=CHUNK_COLUMNS)], ignore_index=True)
+        tmp_chunks_path = self.chunks_path + ".tmp"
+        chunks.to_parquet(tmp_chunks_path, index=False)
+        tmp_metadata_path = self.metadata_path + ".tmp"
+        _write_metadata(df, tmp_metadata_path, content_name)
+        tree = DirectoryTree.from_files(_ingested(df))
+
+        with self.lock.write():
+            search.commit()
+            os.replace(tmp_chunks_path, self.chunks_path)
+            os.replace(tmp_metadata_path, self.metadata_path)
+            tree.save(self.tree_path)
+        logger.info(
+            f"Patched repo index {self.metadata_path}: {len(rows)} updated, {len(set(removed_paths))} removed")
+        return df, offset
+
+    def compact(self):
+        """Rewrite the blob so it only holds contents referenced by the metadata."""
+        with self._write_mutex:
+            logger.info(f"Compacting repo index {self.metadata_path}")
+            chunks = {file_path: group.drop(columns='file_path').to_dict('records')
+                      for file_path, group in self.chunks().groupby('file_path', sort=False)}
+            records = self.attach_content(self.metadata()).to_dict('records')
+            for record in records:
+                record['chunks'] = chunks.get(record['file_path'], [])
+            return self._write(records)
+
+    def metadata(self):
+        """Return the metadata table, re-reading it only when the file changed."""
+        with self._load_lock:
+            mtime = _stat_key(self.metadata_path)
+            if self._metadata is None or self._metadata_mtime != mtime:
+                # table and blob name come from the same open file, even if it is replaced meanwhile
+                with open(self.metadata_path, "rb") as f:
+                    mtime = _stat_key(f.fileno())
+                    parquet_file = pq.ParquetFile(f)
+                    metadata = parquet_file.read().to_pandas()
+                    schema_metadata = parquet_file.schema_arrow.metadata or {}
+                if 'path_key' not in metadata.columns or metadata['path_key'].isna().any():
+                    # indexes written before path_key existed
+                    metadata['path_key'] = path_keys(metadata['file_path'])
+                if int(schema_metadata.get(RENDER_VERSION_KEY, b"0")) != RENDER_VERSION:
+                    # counted by an older renderer, recounted where they are used
+                    for column in COMPRESSED_TOKEN_COLUMNS:
+                        if column in metadata.columns:
+                            metadata[column] = None
+                self._metadata = metadata
+                self._files = _ingested(metadata)
+                self._content_name = schema_metadata.get(CONTENT_FILE_KEY, CONTENT_FILE.encode()).decode()
+                self._path_index = None
+                self._tree = None
+                self._metadata_mtime = mtime
+            return self._metadata
+
+    def files(self):
+        """Return the metadata rows of ingested files, leaving out skipped ones."""
+        with self._load_lock:
+            self.metadata()
+            return self._files
+
+    def summary(self):
+        """(file count, token count) of the ingested files."""
+        files = self.files()
+        return len(files), int(files['token_count'].fillna(0).sum())
+
+    def path_index(self):
+        """PathIndex over files(), built once per version of the index."""
+        with self._load_lock:
+            files = self.files()
+            if self._path_index is None:
+                self._path_index = PathIndex(files)
+            return self._path_index
+
+    def tree(self):
+        """DirectoryTree of the ingested files, loaded from disk or built once for older indexes."""
+        with self._load_lock:
+            self.metadata()
+            if self._tree is None:
+                if os.path.exists(self.tree_path) and os.path.getmtime(self.tree_path) >= os.path.getmtime(self.metadata_path):
+                    self._tree = DirectoryTree.load(self.tree_path)
+                else:
+                    self._tree = DirectoryTree.from_files(self.files())
+                    self._tree.save(self.tree_path)
+            return self._tree
+
+    def search_index(self):
+        """SearchIndex over the file contents, built from the blob for indexes that predate it."""
+        with self._load_lock:
+            if self._search is None and os.path.exists(self.search_path) \
+                    and search_version(self.search_path) < SEARCH_VERSION:
+                logger.info(f"Search index {self.search_path} has an older layout, rebuilding it")
+                os.remove(self.search_path)
+            if not os.path.exists(self.search_path):
+                self.close_search()
+                logger.info(f"Building search index {self.search_path}")
+                # readers only hold the read lock here, so the name must not clash with
+                # another rebuild or with a write() building its own search index
+                tmp_search_path = _unique_tmp_path(self.search_path)
+                search = SearchIndex(tmp_search_path)
+                try:
+                    files = self.files()
+                    for file_path, offset, length in zip(files['file_path'], files['content_offset'], files['content_length']):
+                        if length:
+                            search.add(file_path, self.read_content(offset, length))
+                            if search.needs_commit():
+                                search.commit()
+                    search.commit()
+                except BaseException:
+                    search.close()
+                    os.remove(tmp_search_path)
+                    raise
+                search.close()
+                os.replace(tmp_search_path, self.search_path)
+            inode = os.stat(self.search_path).st_ino
+            if self._search is None or self._search_inode != inode:
+                # the file is replaced, not modified, when the whole index is rewritten
+                self.close_search()
+                self._search = SearchIndex(self.search_path)
+                self._search_inode = inode
+            return self._search
+
+    def close_search(self):
+        with self._load_lock:
+            if self._search is not None:
+                self._search.close()
+            self._search = None
+            self._search_inode = None
+
+    def chunks(self):
+        """Return the chunk table; files that were not split have no rows."""
+        if not os.path.exists(self.chunks_path):
+            # indexes written before files were chunked
+            return pd.DataFrame(columns=CHUNK_COLUMNS)
+        with self._load_lock:
+            mtime = _stat_key(self.chunks_path)
+            if self._chunks is None or self._chunks_mtime != mtime:
+                self._chunks = pd.read_parquet(self.chunks_path)
+                self._chunks_mtime = mtime
+            return self._chunks
+
+    def skipped_files(self):
+        df = self.metadata()
+        if 'skip_reason' not in df.columns:
+            return df.iloc[0:0][['file_path']].assign(skip_reason=None)
+        return df[df['skip_reason'].notna()][['file_path', 'file_size', 'skip_reason']]
+
+    def _content_buffer(self):
+        with self._load_lock:
+            content_path = self.content_path
+            key = (content_path, _stat_key(content_path))
+            if self._content_map is None or self._content_key != key:
+                # the previous map is not closed: other readers may still be slicing it,
+                # and it is unmapped once the last of them lets go of it
+                with open(content_path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size > 0:
+                        self._content_map = mmap.mmap(
+                            f.fileno(), 0, access=mmap.ACCESS_READ)
+                    else:
+                        # mmap cannot map an empty file
+                        self._content_map = b''
+                self._content_key = key
+            return self._content_map
+
+    def read_content(self, offset, length):
+        if not length:
+            return ''
+        buffer = memoryview(self._content_buffer())
+        return str(buffer[int(offset):int(offset) + int(length)], 'utf-8')
+
+    def attach_content(self, df):
+        """Return a copy of df with a 'file_content' column read from the blob."""
+        df = df.copy()
+        df['file_content'] = [
+            self.read_content(offset, length)
+            for offset, length in zip(df['content_offset'], df['content_length'])
+        ]
+        return df
+
+    def close(self):
+        """Unmap the content blob; only while no reader uses the index, e.g. under lock.write()."""
+        with self._load_lock:
+            if isinstance(self._content_map, mmap.mmap):
+                self._content_map.close()
+            self._content_map = None
+            self._content_key = None
+
+    def migrate_from_csv(self):
+        """Convert a legacy repo_stats.csv into the index format and trash the CSV."""
+        csv_path = os.path.join(self.repo_path, LEGACY_CSV_FILE)
+        if not os.path.exists(csv_path):
+            return False
+        logger.info(f"Migrating {csv_path} to {METADATA_FILE}")
+        df = pd.read_csv(csv_path)
+        df['file_content'] = df['file_content'].fillna('')
+        records = df.astype(object).where(df.notna(), None).to_dict('records')
+        self.write(records)
+        send2trash(csv_path)
+        return True
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_repo_index(repo_path):
+    """The RepoIndex of a repository shared by every user in this process, so its tables are loaded once."""
+    key = os.path.abspath(repo_path)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = RepoIndex(repo_path)
+        return index
+
+
+def release_repo_index(repo_path):
+    """Forget the shared RepoIndex of a repository that is being deleted."""
+    with _indexes_lock:
+        _indexes.pop(os.path.abspath(repo_path), None)
+
+
+def _unique_tmp_path(path):
+    """Path of a new empty file next to path, for building a replacement of it."""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    return tmp_path
+
+
+def _write_metadata(df, path, content_name):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), CONTENT_FILE_KEY: content_name.encode(),
+         RENDER_VERSION_KEY: str(RENDER_VERSION).encode()})
+    pq.write_table(table, path)
+
+
+def _ingested(metadata):
+    """Rows of files that were ingested, leaving out skipped ones."""
+    if 'skip_reason' not in metadata.columns:
+        return metadata
+    return metadata[metadata['skip_reason'].isna()].reset_index(drop=True)
+
+
+def _blob_generation(name):
+    generation = name[len(CONTENT_FILE_PREFIX):-len(".bin")]
+    # the unnumbered blob of older indexes comes first
+    return int(generation) if generation.isdigit() else -1
+
+
+def _chunk_rows(record):
+    return [{'file_path': record['file_path'], **{col: chunk.get(col) for col in CHUNK_COLUMNS[1:]}}
+            for chunk in record.get('chunks') or []]
+
+
+def migrate_legacy_indexes(repos_dir):
+    """One-time migration of every repo_stats.csv found in repos_dir."""
+    migrated = 0
+    for repo_dir in os.listdir(repos_dir):
+        repo_path = os.path.join(repos_dir, repo_dir)
+        if not os.path.isdir(repo_path):
+            continue
+        if LEGACY_CSV_FILE in os.listdir(repo_path) and METADATA_FILE not in os.listdir(repo_path):
+            try:
+                if RepoIndex(repo_path).migrate_from_csv():
+                    migrated += 1
+            except (OSError, ValueError, pd.errors.ParserError) as e:
+                logger.error(f"Failed to migrate {repo_path}: {e}")
+    if migrated:
+        logger.info(f"Migrated {migrated} repositories to the new index format.")
+    return migrated
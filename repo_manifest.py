@@ -0,0 +1,111 @@
+import os
+import json
+import threading
+from loguru import logger
+from file_lock import file_lock
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_FIELDS = ('repo_url', 'repo_name', 'indexed_sha', 'file_count', 'token_count', 'status', 'last_updated')
+# repositories being cloned and indexed for the first time have no usable index yet
+PENDING_STATUSES = ('adding',)
+
+
+class RepoManifest:
+    """Summary of every repository in repos_dir, kept in one JSON file.
+
+    Each entry holds the url, directory name, indexed commit, file and token
+    counts, status ('adding', 'ready' or 'updating') and last index time of a
+    repository, so the repository list is known at startup without opening
+    any repository directory.
+
+    The app and the update-all command share the file. Every change re-reads
+    it under a file lock, applies itself to what is there and writes it back
+    atomically, and reads pick up the file again whenever another process
+    replaced it.
+    """
+
+    def __init__(self, repos_dir):
+        self.path = os.path.join(repos_dir, MANIFEST_FILE)
+        self.lock_path = self.path + ".lock"
+        self.lock = threading.Lock()
+        self.entries = {}  # repo_url -> entry
+        self._file_key = None
+
+    def load(self):
+        """Read the manifest, returning False if there is none (or it is unreadable) and it must be rebuilt."""
+        if not os.path.exists(self.path):
+            return False
+        with self.lock:
+            try:
+                self._read()
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Cannot read manifest {self.path}, rebuilding it: {e}")
+                return False
+        return True
+
+    def _read(self):
+        with open(self.path, "r") as f:
+            stat = os.fstat(f.fileno())
+            entries = json.load(f)["repos"]
+        self.entries = {entry['repo_url']: entry for entry in entries}
+        self._file_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _refresh(self):
+        # the file is only ever replaced, so a new inode, mtime or size means another writer
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self._file_key:
+            try:
+                self._read()
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Cannot re-read manifest {self.path}, keeping the loaded entries: {e}")
+
+    def _update(self, change):
+        """Apply change(entries) to the current file contents and write them back, under the file lock."""
+        with self.lock, file_lock(self.lock_path):
+            self._refresh()
+            if change(self.entries) is False:
+                return
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"repos": list(self.entries.values())}, f, indent=1)
+            os.replace(tmp_path, self.path)
+            stat = os.stat(self.path)
+            self._file_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def replace_all(self, entries):
+        def change(current):
+            current.clear()
+            current.update((entry['repo_url'], entry) for entry in entries)
+        self._update(change)
+
+    def get(self, repo_url):
+        with self.lock:
+            self._refresh()
+            entry = self.entries.get(repo_url)
+            return dict(entry) if entry is not None else None
+
+    def set(self, repo_url, **fields):
+        """Create or update the entry of a repository."""
+        def change(current):
+            entry = current.setdefault(
+                repo_url, {field: None for field in MANIFEST_FIELDS})
+            entry.update(fields, repo_url=repo_url)
+        self._update(change)
+
+    def remove(self, repo_url):
+        self._update(lambda current: current.pop(repo_url, None) is not None)
+
+    def urls(self):
+        """Urls of the repositories that have an index, in the order they were added."""
+        with self.lock:
+            self._refresh()
+            return [url for url, entry in self.entries.items() if entry['status'] not in PENDING_STATUSES]
+
+    def pending(self):
+        """Entries of the repositories still being added."""
+        with self.lock:
+            self._refresh()
+            return [dict(entry) for entry in self.entries.values() if entry['status'] in PENDING_STATUSES]
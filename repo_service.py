@@ -1,19 +1,35 @@
 import os
+import re
 import subprocess
 import zipfile
 import time
 import json
+import shutil
+import inspect
+import itertools
+import threading
 import nbformat
 import requests
-from git import Repo, GitCommandError, NoSuchPathError, InvalidGitRepositoryError
+from git import Repo, RemoteProgress, GitCommandError, NoSuchPathError, InvalidGitRepositoryError
 from loguru import logger
 from send2trash import send2trash
 import pandas as pd
-from pygments.lexers import guess_lexer_for_filename, TextLexer
-from functools import wraps
-from pygments.util import ClassNotFound
-from token_count import num_tokens_from_string
+from functools import partial, wraps
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from token_count import get_encoding, num_tokens_cached, num_tokens_from_string, num_tokens_from_strings
+from content_cache import ContentCache, git_blob_sha
 from config import Config
+from repo_index import RepoIndex, get_repo_index, migrate_legacy_indexes, release_repo_index
+from context_cache import context_cache, make_key
+from context_packing import BM25, pack_chunks, pack_files, tokenize_text
+from language_detect import detect_language
+from chunking import chunk_stub, chunk_text, get_chunk_min_tokens, lex, planned_chunk_tokens, render_chunks, split_chunks
+from job_queue import JobQueue
+from file_lock import file_lock
+from repo_manifest import PENDING_STATUSES, RepoManifest
+from render_modes import COMPRESSED_MODES, COMPRESSED_TOKEN_COLUMNS, MODE_TOKEN_COLUMNS, RENDER_VERSION, render
+from file_filter import BINARY_SNIFF_SIZE, IGNORED_DIRS, FileFilter, get_max_file_size, is_binary
 
 
 def convert_ipynb_to_text(ipynb_content):
@@ -40,6 +56,36 @@ def convert_ipynb_to_text(ipynb_content):
     return text.strip()
 
 
+SEPARATOR = '\n\n' + '=' * 10 + '\n\n'
+
+
+def format_file_block(row, concat_method='xml', metadata_list=None):
+    """Return the (prefix, suffix) wrapped around a file's content in the context."""
+    if metadata_list:
+        metadata = [str(row[col]) for col in metadata_list]
+    else:
+        metadata = ""
+
+    if concat_method == 'xml':
+        prefix = f'<file name="{row["file_path"]}">\n'
+        if metadata:
+            prefix += f'<metadata>{", ".join(metadata)}</metadata>\n'
+        prefix += '<content>\n'
+        suffix = '\n</content>\n</file>'
+    else:
+        prefix = f'File: {row["file_path"]}\n'
+        if metadata:
+            prefix += f'Metadata: {", ".join(metadata)}\n'
+        prefix += 'Content:\n'
+        suffix = ''
+    return prefix, suffix
+
+
+def join_context_blocks(blocks):
+    """Join the (block, total_tokens) pairs of RepoService.iter_context_blocks into one string."""
+    return ''.join(block for block, _ in blocks).strip()
+
+
 def retry(max_retries=3, retry_delay=5):
     def decorator(func):
         @wraps(func)
@@ -64,15 +110,256 @@ def retry(max_retries=3, retry_delay=5):
     return decorator
 
 
+def reads_index(method):
+    """Run a RepoService method under the read lock of its index, so a re-index cannot swap it midway.
+
+    Generators hold the lock from their first step until they are exhausted or closed.
+    """
+    if inspect.isgeneratorfunction(method):
+        @wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            with self.index.lock.read():
+                yield from method(self, *args, **kwargs)
+        return generator_wrapper
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.index.lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def skipped_record(rel_path, reason, file_size=None):
+    """Index row for a file that is listed but whose content is not ingested."""
+    return {
+        'file_content': '',
+        'language': None,
+        'line_count': 0,
+        'file_size': file_size,
+        'file_name': os.path.basename(rel_path.rstrip('/\\')),
+        'file_path': rel_path,
+        'token_count': 0,
+        'description': None,
+        'graph': None,
+        'blob_sha': None,
+        'skip_reason': reason,
+        'chunks': [],
+        **{column: 0 for column in COMPRESSED_TOKEN_COLUMNS},
+    }
+
+
+def process_file(task):
+    """Read a file unless it is too large or binary.
+
+    language and token_count are filled in by process_files.
+    """
+    file_path, rel_path = task
+    file = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+    max_file_size = get_max_file_size()
+    if max_file_size and file_size > max_file_size:
+        return skipped_record(rel_path, 'too large', file_size)
+    with open(file_path, 'rb') as f:
+        head = f.read(BINARY_SNIFF_SIZE)
+        if is_binary(head):
+            return skipped_record(rel_path, 'binary', file_size)
+        raw = head + f.read()
+    language = None
+    if file.endswith('.ipynb'):
+        notebook = nbformat.reads(raw.decode('utf-8'), as_version=4)
+        content = nbformat.writes(notebook)
+        language = 'Jupyter Notebook'
+    else:
+        # same text as reading in text mode with universal newlines
+        content = raw.decode('utf-8', errors='ignore').replace(
+            '\r\n', '\n').replace('\r', '\n')
+
+    return {
+        'file_content': content,
+        'language': language,
+        'line_count': len(content.split('\n')),
+        'file_size': len(raw),
+        'file_name': file,
+        'file_path': rel_path,
+        'token_count': None,
+        'description': None,
+        'graph': None,
+        'blob_sha': git_blob_sha(raw),
+        'skip_reason': None,
+        'chunks': None,
+    }
+
+
+_content_cache = threading.local()
+
+
+def get_content_cache():
+    # sqlite connections must not cross a fork or a thread, so each worker
+    # process and each updating thread opens its own
+    cache = getattr(_content_cache, "cache", None)
+    if cache is None or cache[0] != os.getpid():
+        cache = _content_cache.cache = (os.getpid(), ContentCache())
+    return cache[1]
+
+
+def process_files(tasks):
+    """Process a batch of files, analysing only content not found in the content cache.
+
+    Runs inside ingestion worker processes, so it must stay a module-level function.
+    """
+    records = [process_file(task) for task in tasks]
+    encoding = get_encoding().name
+    min_tokens = get_chunk_min_tokens()
+    cache = get_content_cache()
+    cached = cache.get_many(
+        [(record['blob_sha'], record['file_name']) for record in records if record['skip_reason'] is None], encoding)
+
+    misses = []
+    incomplete = []
+    for record, (file_path, _) in zip(records, tasks):
+        if record['skip_reason'] is not None:
+            continue
+        hit = cached.get((record['blob_sha'], record['file_name']))
+        if hit is not None:
+            record['token_count'], record['language'], record['chunks'], mode_tokens, chunk_min_tokens = hit
+            if record['chunks'] is None or mode_tokens is None or chunk_min_tokens != min_tokens \
+                    or mode_tokens.pop('render_version', None) != RENDER_VERSION:
+                # cached before chunks and render modes were stored, chunked with another
+                # threshold, or counted by an older renderer
+                incomplete.append(record)
+            else:
+                record.update(mode_tokens)
+            continue
+        if record['language'] is None:
+            record['language'] = detect_language(
+                file_path, record['file_content'])
+        misses.append(record)
+
+    token_counts = num_tokens_from_strings(
+        [record['file_content'] for record in misses])
+    for record, token_count in zip(misses, token_counts):
+        record['token_count'] = token_count
+    analyse_records(misses + incomplete)
+    cache.put_many([(record['blob_sha'], record['file_name'], record['token_count'], record['language'], record['chunks'],
+                     {'render_version': RENDER_VERSION, **{column: record[column] for column in COMPRESSED_TOKEN_COLUMNS}})
+                    for record in misses + incomplete], encoding, min_tokens)
+    return records
+
+
+def analyse_records(records):
+    """Fill in the chunks and the token counts of every render mode of records.
+
+    Each file is lexed once. Files of at least chunk_min_tokens tokens are split
+    (see chunking.split_chunks) and every chunk gets the token count of its text
+    and of the stub that replaces it when it is left out.
+    """
+    min_tokens = get_chunk_min_tokens()
+    texts = []
+    for record in records:
+        content = record['file_content']
+        tokens = None
+        if record['language'] != 'Jupyter Notebook':
+            tokens = lex(content, record['language'])
+        record['chunks'] = []
+        if tokens is not None and record['token_count'] >= min_tokens:
+            record['chunks'] = split_chunks(
+                content, record['language'], tokens=tokens)
+        texts += [render(content, record['language'], mode, tokens=tokens)
+                  for mode in COMPRESSED_MODES]
+        lines = content.split('\n')
+        for chunk in record['chunks']:
+            texts += [chunk_text(lines, chunk), chunk_stub(chunk)]
+
+    counts = iter(num_tokens_from_strings(texts))
+    for record in records:
+        for column in COMPRESSED_TOKEN_COLUMNS:
+            record[column] = next(counts)
+        for chunk in record['chunks']:
+            chunk['token_count'] = next(counts)
+            chunk['stub_tokens'] = next(counts)
+
+
+def get_ingest_workers():
+    workers = Config.get("ingest_workers", 0)
+    if not workers or workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def iter_file_records(tasks, workers, progress=None):
+    """Yield process_file results in task order, sharded across a process pool.
+
+    progress(done, total) is called with the number of files processed so far,
+    once before the first batch and after every batch.
+    """
+    batch_size = max(1, min(256, len(tasks) // (workers * 4)))
+    batches = [tasks[i:i + batch_size]
+               for i in range(0, len(tasks), batch_size)]
+
+    def reported(results):
+        done = 0
+        if progress is not None:
+            progress(done, len(tasks))
+        for records in results:
+            yield from records
+            done += len(records)
+            if progress is not None:
+                progress(done, len(tasks))
+
+    if workers <= 1 or len(batches) <= 1:
+        yield from reported(map(process_files, batches))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from reported(executor.map(process_files, batches))
+
+
+class GitProgress(RemoteProgress):
+    """Forwards the object counts of a git fetch or pull as progress(stage, done, total)."""
+
+    def __init__(self, progress, stage):
+        super().__init__()
+        self.progress = progress
+        self.stage = stage
+
+    def update(self, op_code, cur_count, max_count=None, message=''):
+        if max_count:
+            self.progress(self.stage, int(cur_count), int(max_count))
+
+
+CLONE_STRATEGIES = ("full", "shallow", "blobless", "sparse")
+JOB_KINDS = ("add", "update", "delete")
+# held while a repository is updated, so the app and the update-all command never update it at once
+UPDATE_LOCK_FILE = ".update.lock"
+
+
+def repo_name_from_url(repo_url):
+    return repo_url.split("/")[-1].replace(".git", "")
+
 
 class RepoService:
-    def __init__(self, repo_url, repo_name=None):
+    def __init__(self, repo_url, repo_name=None, clone_strategy=None, sparse_patterns=None, progress_callback=None):
         self.repo_url = repo_url
-        self.repo_name = repo_name if repo_name else repo_url.split(
-            "/")[-1].replace(".git", "")
+        self.repo_name = repo_name if repo_name else repo_name_from_url(repo_url)
         self.repo_path = os.path.join(Config["repos_dir"], self.repo_name)
         self.clone_path = os.path.join(
             self.repo_path, self.repo_name + "-main")
+        self.index = get_repo_index(self.repo_path)
+        # called as progress_callback(stage, done, total)
+        self.progress_callback = progress_callback
+
+        # explicit arguments win, then what the repo was cloned with, then config.yaml
+        repo_info = self._read_repo_info()
+        self.clone_strategy = (clone_strategy or repo_info.get("clone_strategy")
+                               or Config.get("clone_strategy", "full")).lower()
+        if self.clone_strategy not in CLONE_STRATEGIES:
+            raise ValueError(
+                f"Invalid clone strategy: {self.clone_strategy}, expected one of {CLONE_STRATEGIES}")
+        self.sparse_patterns = list(sparse_patterns or repo_info.get(
+            "sparse_patterns") or Config.get("sparse_patterns") or [])
+
+        if not self.index.exists():
+            self.index.migrate_from_csv()
 
         if self.check_if_exist():
             logger.info(
@@ -82,11 +369,10 @@ class RepoService:
 
     def check_if_exist(self):
         repo_info_path = os.path.join(self.repo_path, "repo_info.json")
-        csv_path = os.path.join(self.repo_path, "repo_stats.csv")
 
-        if not os.path.exists(repo_info_path) or not os.path.exists(csv_path):
+        if not os.path.exists(repo_info_path) or not self.index.exists():
             return False
-        if pd.read_csv(csv_path).empty:
+        if self.index.is_empty():
             return False
 
         with open(repo_info_path, "r") as f:
@@ -102,16 +388,19 @@ class RepoService:
     def set_up(self):
         if not os.path.exists(self.repo_path):
             os.makedirs(self.repo_path, exist_ok=True)
-        repo_info = {"repo_url": self.repo_url}
+        repo_info = {"repo_url": self.repo_url,
+                     "clone_strategy": self.clone_strategy,
+                     "sparse_patterns": self.sparse_patterns}
         with open(os.path.join(self.repo_path, "repo_info.json"), "w") as f:
             json.dump(repo_info, f)
         self.clone_repo()
-        if not os.path.exists(os.path.join(self.repo_path, "repo_stats.csv")):
+        if not self.index.exists():
             self.get_repo_stats()
+            self._write_repo_info(indexed_sha=self._get_head_sha())
         logger.info(
             f"Repository {self.repo_name} set up successfully at {self.repo_path}")
         logger.info(
-            f"Last updated: {time.ctime(os.path.getmtime(os.path.join(self.repo_path, 'repo_stats.csv')))}")
+            f"Last updated: {time.ctime(self.index.last_modified())}")
 
     def clone_repo(self):
         if os.path.exists(self.clone_path) and os.listdir(self.clone_path):
@@ -142,7 +431,7 @@ class RepoService:
                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             self._clone_using_git()
             return True
-        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError) as e:
             logger.error(
                 f"Failed to clone repository {self.repo_name} using Git. {e}")
             self.delete_repo()
@@ -160,52 +449,256 @@ class RepoService:
 
     @retry(max_retries=1, retry_delay=5)
     def _clone_using_git(self):
-        logger.info(f"Cloning repository {self.repo_name} using Git...")
-        subprocess.run(["git", "clone", self.repo_url,
-                       self.clone_path], check=True, timeout=60)
+        logger.info(
+            f"Cloning repository {self.repo_name} using Git ({self.clone_strategy} clone)...")
+        # git reports no totals up front, so the stage is shown without a count
+        self._report_progress("clone", 0, 0)
+        timeout = Config.get("clone_timeout", 300)
+        strategy = self.clone_strategy
+        if strategy == "sparse" and not self.sparse_patterns:
+            logger.warning(
+                f"No sparse_patterns set for {self.repo_name}, checking out the whole tree.")
+            strategy = "blobless"
+
+        clone_args = {
+            "full": [],
+            "shallow": ["--depth", "1"],
+            "blobless": ["--filter=blob:none"],
+            # blobs outside the sparse patterns are never downloaded
+            "sparse": ["--filter=blob:none", "--no-checkout"],
+        }[strategy]
+        subprocess.run(["git", "clone", *clone_args, self.repo_url,
+                       self.clone_path], check=True, timeout=timeout)
+
+        if strategy == "sparse":
+            self._report_progress("checkout", 0, 0)
+            subprocess.run(["git", "-C", self.clone_path, "sparse-checkout", "set", "--no-cone",
+                            *self.sparse_patterns], check=True, timeout=timeout)
+            subprocess.run(["git", "-C", self.clone_path, "checkout"],
+                           check=True, timeout=timeout)
 
     @retry(max_retries=1, retry_delay=5)
     def _clone_using_download(self):
         logger.info(f"Cloning repository {self.repo_name} using download...")
-        response = requests.get(self.repo_url, timeout=60)
-        if response.status_code == 200:
-            with open(os.path.join(self.repo_path, "repo.zip"), "wb") as f:
-                f.write(response.content)
-            with zipfile.ZipFile(os.path.join(self.repo_path, "repo.zip"), "r") as zip_ref:
-                zip_ref.extractall(self.repo_path)
-            os.remove(os.path.join(self.repo_path, "repo.zip"))
-        else:
-            raise requests.exceptions.RequestException(
-                f"Failed to download repository {self.repo_name}")
+        zip_path = os.path.join(self.repo_path, "repo.zip")
+        part_path = zip_path + ".part"
+        # interrupted transfers resume from the end of the partial file, see _download_file
+        self._download_file(self.repo_url, part_path)
+        os.replace(part_path, zip_path)
+        self._extract_zip(zip_path)
+        os.remove(zip_path)
+
+    def _download_file(self, url, path, chunk_size=64 * 1024):
+        """Download url to path, resuming with a Range request each time the connection drops.
+
+        A drop loses at most the chunk being read, so chunk_size stays small.
+        Gives up after download_retries interruptions; HTTP errors are not retried.
+        """
+        max_retries = Config.get("download_retries", 5)
+        retry_delay = Config.get("download_retry_delay", 1.0)
+        for attempt in range(max_retries + 1):
+            try:
+                return self._download_range(url, path, chunk_size)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                if attempt == max_retries:
+                    raise
+                logger.warning(
+                    f"Download of {self.repo_name} interrupted, resuming ({attempt + 1}/{max_retries}): {e}")
+                time.sleep(retry_delay * 2 ** attempt)
+
+    def _download_range(self, url, path, chunk_size):
+        """Download what path is missing of url, appending to it."""
+        downloaded = os.path.getsize(path) if os.path.exists(path) else 0
+        headers = {"Range": f"bytes={downloaded}-"} if downloaded else {}
+        with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 416:
+                # the partial file already holds the whole archive
+                return
+            if response.status_code == 200:
+                downloaded = 0  # server ignored the range request, start over
+            elif response.status_code != 206:
+                raise requests.exceptions.HTTPError(
+                    f"Failed to download repository {self.repo_name}: HTTP {response.status_code}", response=response)
+
+            content_length = response.headers.get("Content-Length")
+            total = downloaded + \
+                int(content_length) if content_length else None
+            with open(path, "ab" if downloaded else "wb") as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    downloaded += len(chunk)
+                    self._report_progress("download", downloaded, total)
+
+        if total is not None and downloaded < total:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Download of {self.repo_name} ended early ({downloaded}/{total} bytes)")
+
+    def _extract_zip(self, zip_path):
+        file_filter = FileFilter()
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            members = [member for member in zip_ref.infolist()
+                       if not member.is_dir()]
+            extracted = 0
+            for i, member in enumerate(members):
+                # archives wrap everything in a top-level "<repo>-<branch>/" folder
+                rel_path = member.filename.split('/', 1)[-1]
+                if file_filter.exclusion_reason(rel_path, size=member.file_size) is None:
+                    zip_ref.extract(member, self.repo_path)
+                    extracted += 1
+                self._report_progress("extract", i + 1, len(members))
+        logger.info(
+            f"Extracted {extracted} of {len(members)} files of {self.repo_name}")
+
+    def _report_progress(self, stage, done, total):
+        if self.progress_callback is not None:
+            self.progress_callback(stage, done, total)
+        elif total and done == total:
+            logger.info(f"{self.repo_name}: {stage} finished ({done}/{total})")
+
+    def update_repo(self, ingest_workers=None):
+        """Fetch and check out the remote head, then re-index what changed.
+
+        Other updates of the repository, in this or another process, are
+        waited for. ingest_workers caps the indexing processes (see get_ingest_workers).
+        """
+        with file_lock(os.path.join(self.repo_path, UPDATE_LOCK_FILE)):
+            return self._update_repo(ingest_workers)
 
-    def update_repo(self):
+    def _update_repo(self, ingest_workers):
         try:
             logger.info(f"Updating repository {self.repo_name}...")
             repo = Repo(self.clone_path)
             origin = repo.remotes.origin
-            origin.fetch()  # Fetches the latest changes from the remote repository but does not merge them
+            # Fetches the latest changes from the remote repository but does not merge them
+            self._report_progress("fetch", 0, 0)
+            # only parse git's progress output when someone is listening
+            fetch_progress = GitProgress(self._report_progress, "fetch") if self.progress_callback else None
+            if self.clone_strategy == "shallow":
+                origin.fetch(depth=1, progress=fetch_progress)  # keep the clone one commit deep
+            else:
+                origin.fetch(progress=fetch_progress)
 
             current_commit = repo.head.commit  # get the current commit
             # get the remote commit
             remote_commit = origin.refs[repo.active_branch.name].commit
 
+            indexed_sha = self._read_repo_info().get("indexed_sha")
             if current_commit.hexsha == remote_commit.hexsha:
+                if not indexed_sha:
+                    self._write_repo_info(indexed_sha=current_commit.hexsha)
                 logger.info(
                     f"Repository {self.repo_name} is already up-to-date.")
                 return True  # if the current commit is the same as the remote commit, the repository is up-to-date
 
             # if the current commit is not the same as the remote commit, pull the changes
-            origin.pull()
+            self._report_progress("update", 0, 0)
+            if self.clone_strategy == "shallow":
+                # a depth-1 fetch shares no history with HEAD, so move to it instead of merging
+                repo.git.reset("--hard", remote_commit.hexsha)
+            else:
+                origin.pull(progress=GitProgress(self._report_progress, "update") if self.progress_callback else None)
             logger.info(f"Repository {self.repo_name} updated successfully.")
+            context_cache.invalidate(self.repo_path)
 
-            # after updating the repository, get the latest stats
-            self.get_repo_stats()
+            # after updating the repository, re-index only what changed since the indexed commit
+            new_sha = repo.head.commit.hexsha
+            if self.index.exists():
+                self.reindex_changes(
+                    repo, indexed_sha or current_commit.hexsha, new_sha, workers=ingest_workers)
+            else:
+                self.get_repo_stats(workers=ingest_workers)
+            self._write_repo_info(indexed_sha=new_sha)
             return True
         except (GitCommandError, NoSuchPathError, InvalidGitRepositoryError) as e:
             logger.error(f"Failed to update repository {self.repo_name}: {e}")
             return False
 
+    def remote_head_sha(self):
+        """SHA of the remote branch the clone tracks, asked with ls-remote without fetching, or None if unknown."""
+        try:
+            branch = Repo(self.clone_path).active_branch.name
+            result = subprocess.run(
+                ["git", "-C", self.clone_path, "ls-remote", "origin", f"refs/heads/{branch}"],
+                capture_output=True, text=True, check=True, timeout=Config.get("ls_remote_timeout", 30))
+        except (TypeError, NoSuchPathError, InvalidGitRepositoryError, subprocess.SubprocessError) as e:
+            # TypeError: detached HEAD
+            logger.warning(f"Cannot read the remote head of {self.repo_name}: {e}")
+            return None
+        fields = result.stdout.split()
+        return fields[0] if fields else None
+
+    def is_up_to_date(self):
+        """True if the remote head is the commit checked out and indexed, so update_repo has nothing to do."""
+        remote_sha = self.remote_head_sha()
+        return remote_sha is not None and remote_sha == self._get_head_sha() == self._read_repo_info().get("indexed_sha")
+
+    def reindex_changes(self, repo, old_sha, new_sha, workers=None):
+        """Patch the index with the files added, modified or deleted between two commits."""
+        try:
+            diff = repo.git.diff("--name-status", "--no-renames",
+                                 "-z", old_sha, new_sha)
+        except GitCommandError as e:
+            logger.warning(
+                f"Cannot diff {old_sha[:7]}..{new_sha[:7]} in {self.repo_name}, re-indexing everything: {e}")
+            return self.get_repo_stats(workers=workers)
+
+        # -z output is "status\0path\0status\0path\0..."; renames show up as a delete plus an add
+        entries = [entry for entry in diff.split('\0') if entry]
+        if any(os.path.basename(path) == '.gitignore' for path in entries[1::2]):
+            # ignore rules changed, so files outside the diff may change status too
+            logger.info(
+                f".gitignore changed in {self.repo_name}, re-indexing everything")
+            return self.get_repo_stats(workers=workers)
+
+        file_filter = FileFilter(self.clone_path)
+        changed, removed, skipped = [], [], []
+        for status, path in zip(entries[0::2], entries[1::2]):
+            rel_path = os.path.normpath(path)
+            file_path = os.path.join(self.clone_path, rel_path)
+            if status.startswith('D') or not os.path.isfile(file_path):
+                removed.append(rel_path)
+                continue
+            reason = file_filter.exclusion_reason(rel_path)
+            if reason is None:
+                changed.append((file_path, rel_path))
+            else:
+                skipped.append(skipped_record(rel_path, reason))
+
+        logger.info(
+            f"Re-indexing {len(changed)} changed and {len(removed)} removed files of {self.repo_name}")
+        # a process pool is not worth starting for a handful of files
+        workers = (workers or get_ingest_workers()) if len(changed) > 64 else 1
+        return self.index.patch(itertools.chain(
+            skipped, iter_file_records(changed, workers, progress=partial(self._report_progress, "index"))), removed)
+
+    def _read_repo_info(self):
+        repo_info_path = os.path.join(self.repo_path, "repo_info.json")
+        if not os.path.exists(repo_info_path):
+            return {}
+        with open(repo_info_path, "r") as f:
+            return json.load(f)
+
+    def _write_repo_info(self, **updates):
+        repo_info = self._read_repo_info()
+        repo_info.update(updates)
+        with open(os.path.join(self.repo_path, "repo_info.json"), "w") as f:
+            json.dump(repo_info, f)
+
+    def _get_head_sha(self):
+        try:
+            return Repo(self.clone_path).head.commit.hexsha
+        except (ValueError, NoSuchPathError, InvalidGitRepositoryError):
+            # downloaded archives have no git metadata
+            return None
+
     def delete_repo(self):
+        context_cache.invalidate(self.repo_path)
+        # wait for readers of the index to finish before its files go away
+        with self.index.lock.write():
+            self.index.close()
+            self.index.close_search()
+        release_repo_index(self.repo_path)
         if os.path.exists(self.repo_path):
             send2trash(self.repo_path)
             logger.info(
@@ -216,83 +709,114 @@ class RepoService:
                 f"Repository {self.repo_name} does not exist at {self.repo_path}")
             return False
 
-    def get_repo_stats(self):
-        data = []
+    def _list_files(self):
+        """Walk the clone, returning (tasks, skipped) where skipped holds index rows
+        for files and directories excluded by path rules."""
+        tasks = []
+        skipped = []
+        file_filter = FileFilter(self.clone_path)
         for root, dirs, files in os.walk(self.clone_path):
-            if '.git' in dirs:
-                dirs.remove('.git')  # don't visit .git directories
+            # don't visit excluded directories such as .git or node_modules
+            kept_dirs = []
+            for d in dirs:
+                rel_dir = os.path.relpath(os.path.join(root, d), self.clone_path)
+                reason = file_filter.dir_exclusion_reason(rel_dir)
+                if reason is None:
+                    kept_dirs.append(d)
+                elif d not in IGNORED_DIRS:
+                    skipped.append(skipped_record(rel_dir + '/', reason))
+            dirs[:] = kept_dirs
 
             for file in files:
                 file_path = os.path.join(root, file)
                 rel_path = os.path.relpath(file_path, self.clone_path)
-                content = ''
-                language = None
-                if file.endswith('.ipynb'):
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        notebook = nbformat.read(f, as_version=4)
-                        content = nbformat.writes(notebook)
-                        language = 'Jupyter Notebook'
+                reason = file_filter.exclusion_reason(
+                    rel_path, check_parents=False)
+                if reason is None:
+                    tasks.append((file_path, rel_path))
                 else:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read()
-
-                    try:
-                        lexer = guess_lexer_for_filename(file_path, content)
-                        language = lexer.name
-                    except ClassNotFound:
-                        language = None
-
-                    if language is not None and isinstance(lexer, TextLexer):
-                        language = None
-
-                data.append({
-                    'file_content': content,
-                    'language': language,
-                    'line_count': len(content.split('\n')),
-                    'file_size': os.path.getsize(file_path),
-                    'file_name': file,
-                    'file_path': rel_path,
-                    'token_count': num_tokens_from_string(content),
-                    'description': None,
-                    'graph': None
-                })
-
-        df = pd.DataFrame(data)
-        csv_path = os.path.join(self.repo_path, "repo_stats.csv")
-        df.to_csv(csv_path, index=False, escapechar='\\')
-        logger.info(f"Saved repo stats to {csv_path}")
-        return df
-
-    def filter_files(self, selected_files=None, selected_folders=None, selected_languages=None):
-        csv_path = os.path.join(self.repo_path, "repo_stats.csv")
-        df = pd.read_csv(csv_path)
-        df['file_path'] = df['file_path'].apply(
-            lambda x: x.replace(os.sep, '/').replace('\\', '/').lower())
-
-        final_condition = pd.Series([False] * len(df))
-
-        if selected_files:
-            selected_files = [path.replace(
-                os.sep, '/').replace('\\', '/').lower() for path in selected_files]
-            final_condition |= df['file_path'].isin(selected_files)
-
-        if selected_folders:
-            selected_folders = [folder.replace(
-                os.sep, '/').replace('\\', '/').lower() for folder in selected_folders]
-            folder_condition = pd.Series([any(df['file_path'].iloc[i].startswith(
-                folder) for folder in selected_folders) for i in range(len(df))])
-            final_condition |= folder_condition
-
-        df = df[final_condition]
-
-        if selected_languages:
-            df = df[df['language'].isin(selected_languages)]
+                    skipped.append(skipped_record(rel_path, reason))
+        return tasks, skipped
 
+    def get_repo_stats(self, workers=None):
+        tasks, skipped = self._list_files()
+        workers = workers or get_ingest_workers()
+        logger.info(
+            f"Indexing {len(tasks)} files of {self.repo_name} with {workers} worker(s), {len(skipped)} excluded by path...")
+        # records are streamed into the index as workers finish them
+        return self.index.write(itertools.chain(
+            skipped, iter_file_records(tasks, workers, progress=partial(self._report_progress, "index"))))
+
+    @reads_index
+    def filter_files(self, selected_files=None, selected_folders=None, selected_languages=None, selected_globs=None, selected_patterns=None):
+        """Like select_files, with the content of the selected files in 'file_content'."""
+        return self.index.attach_content(self.select_files(
+            selected_files=selected_files, selected_folders=selected_folders, selected_languages=selected_languages,
+            selected_globs=selected_globs, selected_patterns=selected_patterns))
+
+    @reads_index
+    def select_files(self, selected_files=None, selected_folders=None, selected_languages=None, selected_globs=None, selected_patterns=None):
+        """Select files by exact path, folder, glob or regex (any of them), then by language.
+
+        Path matching is case-insensitive and accepts either path separator. Only
+        metadata is returned; contents stay in the index until they are needed.
+        """
+        positions = self.index.path_index().select(
+            selected_files=selected_files,
+            selected_folders=selected_folders,
+            selected_languages=selected_languages,
+            selected_globs=selected_globs,
+            selected_patterns=selected_patterns,
+        )
+        df = self.index.files().iloc[positions].copy()
+        df['file_path'] = df['file_path'].str.replace('\\', '/', regex=False)
         return df
 
+    @reads_index
+    def search(self, query, max_files=50, max_lines_per_file=5):
+        """Search file contents, returning one row (file_path, line_number, line) per matching line.
+
+        A single identifier is answered from the identifier postings of the search
+        index. Other queries, and identifiers without an exact match, are matched
+        as case-insensitive substrings in the files that contain all of their
+        trigrams, so only those files are read. Files with the most matching lines
+        come first.
+        """
+        query = query.strip()
+        columns = ['file_path', 'line_number', 'line']
+        if not query:
+            return pd.DataFrame(columns=columns)
+        search = self.index.search_index()
+        files = self.index.files().set_index('file_path')
+
+        def read_lines(file_path):
+            offset, length = files.loc[file_path, ['content_offset', 'content_length']]
+            return self.index.read_content(offset, length).split('\n')
+
+        matches = []
+        if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', query):
+            for file_path, line_numbers in search.find_identifier(query):
+                if file_path in files.index:
+                    lines = read_lines(file_path)
+                    matches.append((file_path, [(n, lines[n - 1]) for n in line_numbers if n <= len(lines)]))
+        if not matches:
+            needle = query.lower()
+            for file_path in search.candidate_files(query) or []:
+                if file_path in files.index:
+                    found = [(n, line) for n, line in enumerate(read_lines(file_path), start=1)
+                             if needle in line.lower()]
+                    if found:
+                        matches.append((file_path, found))
+
+        matches.sort(key=lambda match: (-len(match[1]), match[0]))
+        rows = [(file_path, line_number, line.strip()[:200])
+                for file_path, found in matches[:max_files]
+                for line_number, line in found[:max_lines_per_file]]
+        return pd.DataFrame(rows, columns=columns)
+
+    @reads_index
     def get_language_percentage(self):
-        csv_path = os.path.join(self.repo_path, "repo_stats.csv")
-        df = pd.read_csv(csv_path)
+        df = self.index.files()
 
         if df['language'].isna().all():
             logger.warning(
@@ -310,100 +834,331 @@ class RepoService:
         language_percentage = language_counts / total_lines * 100
         return language_percentage
 
+    @reads_index
     def print_directory_structure(self):
-        directory_structure = {}
-
-        for root, dirs, files in os.walk(self.repo_path):
-            for file in files:
-                file_path = os.path.relpath(
-                    os.path.join(root, file), self.repo_path)
-                parts = file_path.split(os.sep)
-                current_level = directory_structure
-
-                for part in parts:
-                    if part not in current_level:
-                        current_level[part] = {}
-                    current_level = current_level[part]
-
-        def print_structure(structure, level=0):
-            for key, value in structure.items():
-                logger.info('  ' * level + '- ' + key)
-                print_structure(value, level + 1)
-
-        print_structure(directory_structure)
-
-    def preprocess_dataframe(self, df, limit=None, concat_method='xml', include_directory=True, metadata_list=None):
-        result = ''
+        for line in self.index.tree().render_lines():
+            logger.info(line)
+
+    @reads_index
+    def iter_context_blocks(self, df, limit=None, concat_method='xml', include_directory=True, metadata_list=None, render_mode='full'):
+        """Yield (block, total_tokens) for the directory header and then each file block.
+
+        Each piece is tokenized once and total_tokens is the running total, so
+        packing stays linear in the size of the context. Files that would exceed
+        limit are skipped, and the later ones that still fit are kept. Rows without
+        a 'file_content' column are read from the index only when their block is
+        produced. File contents are rendered in render_mode (see
+        render_modes.render), using the token count stored for that mode.
+        """
+        total_tokens = 0
 
         if include_directory:
-            directory_structure = {}
-            for _, row in df.iterrows():
-                file_path = row['file_path']
-                parts = file_path.split('/')
-                current_level = directory_structure
-                for part in parts:
-                    if part not in current_level:
-                        current_level[part] = {}
-                    current_level = current_level[part]
-
-            def flatten_directory(structure, prefix=''):
-                flattened = []
-                for key, value in structure.items():
-                    flattened.append(prefix + key)
-                    flattened.extend(flatten_directory(value, prefix + '  '))
-                return flattened
-
-            directory_lines = flatten_directory(directory_structure)
-            result += 'Directory Structure:\n' + \
-                '\n'.join(directory_lines) + '\n\n'
-
-        for _, row in df.iterrows():
-            r = result
-            result += '\n\n' + '=' * 10 + '\n\n'
-            content = row['file_content']
-            if row['language'] == 'Jupyter Notebook':
-                content = convert_ipynb_to_text(content)
-
-            if metadata_list:
-                metadata = [str(row[col]) for col in metadata_list]
+            header = self._directory_header(df)
+            total_tokens += num_tokens_from_string(header)
+            yield header, total_tokens
+
+        separator = SEPARATOR
+        separator_tokens = num_tokens_from_string(separator)
+        lazy_content = 'file_content' not in df.columns
+
+        for row in df.to_dict('records'):
+            prefix, suffix = format_file_block(
+                row, concat_method=concat_method, metadata_list=metadata_list)
+            wrapper_tokens = 2 * separator_tokens + \
+                num_tokens_from_string(prefix) + num_tokens_from_string(suffix)
+            # reuse the count stored by get_repo_stats unless the content is rewritten here
+            content_tokens = row.get(MODE_TOKEN_COLUMNS[render_mode])
+            if row['language'] == 'Jupyter Notebook' or pd.isna(content_tokens):
+                content_tokens = None
+            # a known count skips files that cannot fit without reading them
+            if limit and content_tokens is not None and total_tokens + wrapper_tokens + int(content_tokens) > limit:
+                continue
+
+            if lazy_content:
+                content = self.index.read_content(
+                    row['content_offset'], row['content_length'])
             else:
-                metadata = ""
-
-            if concat_method == 'xml':
-                result += f'<file name="{row["file_path"]}">\n'
-                if metadata:
-                    result += f'<metadata>{", ".join(metadata)}</metadata>\n'
-                result += f'<content>\n{content}\n</content>\n'
-                result += '</file>'
-            else:
-                result += f'File: {row["file_path"]}\n'
-                if metadata:
-                    result += f'Metadata: {", ".join(metadata)}\n'
-                result += f'Content:\n{content}'
-            result += '\n\n' + '=' * 10 + '\n\n'
-            if limit and num_tokens_from_string(result) > limit:
-                result = r
-                break
-
-        return result.strip()
-
-    def get_filtered_files(self, selected_folders=None, selected_files=None, selected_languages=None, limit=None, concat_method='xml', include_directory=True, metadata_list=None):
-        filtered_files = self.filter_files(
-            selected_folders=selected_folders, selected_files=selected_files, selected_languages=selected_languages)
-        file_string = self.preprocess_dataframe(filtered_files, limit=limit,  concat_method=concat_method,
-                                                include_directory=include_directory, metadata_list=metadata_list)
-        return file_string
+                content = row['file_content']
+            if not isinstance(content, str):
+                content = ''
+            if row['language'] == 'Jupyter Notebook' and content:
+                content = convert_ipynb_to_text(content)
+            content = render(content, row['language'], render_mode)
+            if content_tokens is None:
+                content_tokens = num_tokens_from_string(content)
+
+            block_tokens = wrapper_tokens + int(content_tokens)
+            if limit and total_tokens + block_tokens > limit:
+                continue
+            total_tokens += block_tokens
+            yield ''.join([separator, prefix, content, suffix, separator]), total_tokens
+
+    def _directory_header(self, df):
+        # prune the tree stored with the index down to the selected files
+        directory_lines = self.index.tree().render_lines(df['file_path'])
+        return 'Directory Structure:\n' + '\n'.join(directory_lines) + '\n\n'
+
+    def pack_by_relevance(self, df, question, limit, concat_method='xml', include_directory=True, metadata_list=None, render_mode='full'):
+        """Rank the rows of df against question and keep the most useful ones within limit.
+
+        Files are scored from the term statistics of the search index, so no
+        content is read. Returns a PackResult of (selected, dropped) frames, see
+        context_packing.pack_files.
+        """
+        query_terms, statistics = self._term_statistics(question)
+        scores = self._bm25(statistics, df['file_path']).scores(query_terms)
+        separator_tokens = num_tokens_from_string(SEPARATOR)
+        wrappers = [''.join(format_file_block(row, concat_method=concat_method, metadata_list=metadata_list))
+                    for row in df.to_dict('records')]
+        token_counts = df['token_count']
+        column = MODE_TOKEN_COLUMNS[render_mode]
+        if column in df.columns and not df[column].isna().any():
+            token_counts = df[column]
+        weights = [token_count + wrapper_tokens + 2 * separator_tokens
+                   for token_count, wrapper_tokens in zip(token_counts, num_tokens_from_strings(wrappers))]
+        capacity = limit
+        if include_directory:
+            # the header of every candidate is an upper bound of the final header
+            capacity -= num_tokens_from_string(self._directory_header(df))
+        return pack_files(df, scores, weights, capacity)
+
+    def _term_statistics(self, question):
+        query_terms = tokenize_text(question or '')
+        return query_terms, self.index.search_index().term_statistics(query_terms)
+
+    @staticmethod
+    def _bm25(statistics, file_paths, term_frequencies=None, lengths=None):
+        """BM25 of file_paths (or of the given documents) with the corpus statistics of the index."""
+        if term_frequencies is None:
+            term_frequencies = [statistics.frequencies.get(path, {}) for path in file_paths]
+            lengths = [statistics.lengths.get(path, 0) for path in file_paths]
+        return BM25(term_frequencies, lengths, statistics.document_count,
+                    statistics.average_length, statistics.document_frequency)
+
+    def pack_chunks_by_relevance(self, df, question, limit, concat_method='xml', include_directory=True, metadata_list=None, render_mode='full'):
+        """Like pack_by_relevance, but split files compete for the limit chunk by chunk.
+
+        Files with stored chunks contribute one unit per chunk and the others one
+        unit each. Returns a PackResult over the units, which have file_path, chunk
+        (position among the file's chunks, -1 for a whole file), name and
+        token_count columns; see context_packing.pack_chunks. Chunks are weighed
+        by their full text whatever the render_mode, which can only shrink them.
+        Only files that match the question are read to score their chunks.
+        """
+        query_terms, statistics = self._term_statistics(question)
+        matching = set(statistics.frequencies)
+        chunks = self._chunks_by_file(df)
+        separator_tokens = num_tokens_from_string(SEPARATOR)
+        newline_tokens = num_tokens_from_string('\n')
+        wrappers = [''.join(format_file_block(row, concat_method=concat_method, metadata_list=metadata_list))
+                    for row in df.to_dict('records')]
+        units, weights, file_costs = [], [], {}
+        term_frequencies, lengths = [], []
+        for row, wrapper_tokens in zip(df.to_dict('records'), num_tokens_from_strings(wrappers)):
+            file_path = row['file_path']
+            file_costs[file_path] = wrapper_tokens + 2 * separator_tokens
+            if file_path not in chunks:
+                units.append((file_path, -1, '', row['token_count']))
+                term_frequencies.append(statistics.frequencies.get(file_path, {}))
+                lengths.append(statistics.lengths.get(file_path, 0))
+                weights.append(row['token_count'])
+                continue
+            lines = None
+            if file_path in matching:
+                lines = self.index.read_content(
+                    row['content_offset'], row['content_length']).split('\n')
+            # stubs of every chunk and the newlines joining them are paid up front,
+            # taking a chunk swaps its stub for its text
+            file_costs[file_path] += planned_chunk_tokens(chunks[file_path], (), newline_tokens)
+            for position, chunk in enumerate(chunks[file_path]):
+                units.append((file_path, position, chunk['name'], chunk['token_count']))
+                # a chunk of a file without any query term cannot score either
+                terms = tokenize_text(file_path) + tokenize_text(chunk_text(lines, chunk)) if lines is not None else []
+                term_frequencies.append(Counter(terms))
+                lengths.append(len(terms))
+                weights.append(chunk['token_count'] - chunk['stub_tokens'])
+        units = pd.DataFrame(units, columns=['file_path', 'chunk', 'name', 'token_count'])
+        scores = self._bm25(statistics, None, term_frequencies, lengths).scores(query_terms)
+        capacity = limit
+        if include_directory:
+            capacity -= num_tokens_from_string(self._directory_header(df))
+        return pack_chunks(units, scores, weights, file_costs, capacity)
+
+    def _chunks_by_file(self, df):
+        chunks = self.index.chunks()
+        chunks = chunks.assign(file_path=chunks['file_path'].astype(str).str.replace('\\', '/', regex=False))
+        chunks = chunks[chunks['file_path'].isin(df['file_path'])]
+        return {file_path: group.to_dict('records') for file_path, group in chunks.groupby('file_path', sort=False)}
+
+    def render_chunk_plan(self, df, units):
+        """Rows of df with selected units, their 'file_content' keeping only the selected chunks.
+
+        The pieces of a file do not tokenize to exactly the sum of their stored
+        counts, so a file rendering larger than planned has its least relevant
+        chunks turned back into stubs until it fits its planned size.
+        """
+        chunks = self._chunks_by_file(df)
+        newline_tokens = num_tokens_from_string('\n')
+        relevance = dict(zip(zip(units['file_path'], units['chunk']), units['relevance']))
+        included = units.groupby('file_path')['chunk'].agg(set)
+        df = df[df['file_path'].isin(included.index)].copy()
+        contents, token_counts, rewritten = [], [], []
+        for row in df.to_dict('records'):
+            file_path = row['file_path']
+            content = self.index.read_content(
+                row['content_offset'], row['content_length'])
+            file_chunks = chunks.get(file_path)
+            token_count = row['token_count']
+            kept = set(included[file_path])
+            if file_chunks is not None:
+                planned = planned_chunk_tokens(file_chunks, kept, newline_tokens)
+                text = content
+                if len(kept) < len(file_chunks):
+                    text = render_chunks(content, file_chunks, kept)
+                    token_count = num_tokens_from_string(text)
+                # least relevant first, and among equals the later chunks
+                droppable = sorted(kept, key=lambda i: (relevance[(file_path, i)], -i))
+                while token_count > planned and droppable:
+                    excess = token_count - planned
+                    while droppable and excess > 0:
+                        position = droppable.pop(0)
+                        kept.discard(position)
+                        excess -= file_chunks[position]['token_count'] - file_chunks[position]['stub_tokens']
+                    text = render_chunks(content, file_chunks, kept)
+                    token_count = num_tokens_from_string(text)
+                content = text
+            contents.append(content)
+            token_counts.append(token_count)
+            rewritten.append(file_chunks is not None and len(kept) < len(file_chunks))
+        df['file_content'] = contents
+        df['token_count'] = token_counts
+        # counts of the other modes are taken when the block is built
+        for column in COMPRESSED_TOKEN_COLUMNS:
+            if column in df.columns:
+                df[column] = [None if partial else value for partial, value in zip(rewritten, df[column])]
+        return df
 
+    @reads_index
+    def preprocess_dataframe(self, df, limit=None, concat_method='xml', include_directory=True, metadata_list=None, render_mode='full'):
+        return join_context_blocks(self.iter_context_blocks(df, limit=limit, concat_method=concat_method,
+                                                            include_directory=include_directory, metadata_list=metadata_list,
+                                                            render_mode=render_mode))
+
+    @reads_index
+    def plan_context(self, question, selected_folders=None, selected_files=None, selected_languages=None, limit=None, concat_method='xml', include_directory=True, metadata_list=None, selected_globs=None, selected_patterns=None, granularity='file', render_mode='full'):
+        """Cached pack_by_relevance (or pack_chunks_by_relevance with granularity='chunk')
+        of a selection, returning a PackResult."""
+        key = make_key(
+            self.repo_path,
+            self.index.version(),
+            kind='plan',
+            question=question,
+            granularity=granularity,
+            render_mode=render_mode,
+            selected_folders=sorted(selected_folders or []),
+            selected_files=sorted(selected_files or []),
+            selected_languages=sorted(selected_languages or []),
+            selected_globs=sorted(selected_globs or []),
+            selected_patterns=sorted(selected_patterns or []),
+            limit=limit,
+            concat_method=concat_method,
+            include_directory=include_directory,
+            metadata_list=list(metadata_list or []),
+        )
+        plan = context_cache.get(key)
+        if plan is None:
+            selected = self.select_files(
+                selected_folders=selected_folders, selected_files=selected_files, selected_languages=selected_languages,
+                selected_globs=selected_globs, selected_patterns=selected_patterns)
+            pack = self.pack_chunks_by_relevance if granularity == 'chunk' else self.pack_by_relevance
+            plan = pack(selected, question, limit, concat_method=concat_method,
+                        include_directory=include_directory, metadata_list=metadata_list, render_mode=render_mode)
+            # rough size of the two metadata frames, contents are not kept
+            context_cache.put(key, plan, 200 * len(selected))
+        return plan
+
+    @reads_index
+    def iter_filtered_files(self, selected_folders=None, selected_files=None, selected_languages=None, limit=None, concat_method='xml', include_directory=True, metadata_list=None, selected_globs=None, selected_patterns=None, question=None, granularity='file', render_mode='full'):
+        """Streaming counterpart of get_filtered_files, see iter_context_blocks.
+
+        With a question and a limit, files are chosen by relevance (see plan_context)
+        instead of in index order. With granularity='chunk' and a limit, large files
+        are cut down to the chunks that fit, the rest of them kept as signatures.
+        render_mode selects how much of each file is kept, see render_modes.render.
+        """
+        if granularity == 'chunk' and limit:
+            plan = self.plan_context(
+                question, selected_folders=selected_folders, selected_files=selected_files, selected_languages=selected_languages,
+                limit=limit, concat_method=concat_method, include_directory=include_directory, metadata_list=metadata_list,
+                selected_globs=selected_globs, selected_patterns=selected_patterns, granularity=granularity,
+                render_mode=render_mode)
+            selected = self.render_chunk_plan(self.select_files(
+                selected_folders=selected_folders, selected_files=selected_files, selected_languages=selected_languages,
+                selected_globs=selected_globs, selected_patterns=selected_patterns), plan.selected)
+        elif question and limit:
+            selected = self.plan_context(
+                question, selected_folders=selected_folders, selected_files=selected_files, selected_languages=selected_languages,
+                limit=limit, concat_method=concat_method, include_directory=include_directory, metadata_list=metadata_list,
+                selected_globs=selected_globs, selected_patterns=selected_patterns, render_mode=render_mode).selected
+        else:
+            selected = self.select_files(
+                selected_folders=selected_folders, selected_files=selected_files, selected_languages=selected_languages,
+                selected_globs=selected_globs, selected_patterns=selected_patterns)
+        yield from self.iter_context_blocks(selected, limit=limit, concat_method=concat_method,
+                                            include_directory=include_directory, metadata_list=metadata_list,
+                                            render_mode=render_mode)
+
+    @reads_index
+    def get_filtered_files(self, selected_folders=None, selected_files=None, selected_languages=None, limit=None, concat_method='xml', include_directory=True, metadata_list=None, selected_globs=None, selected_patterns=None, question=None, granularity='file', render_mode='full'):
+        return join_context_blocks(self.iter_filtered_files(
+            selected_folders=selected_folders, selected_files=selected_files, selected_languages=selected_languages,
+            limit=limit, concat_method=concat_method, include_directory=include_directory, metadata_list=metadata_list,
+            selected_globs=selected_globs, selected_patterns=selected_patterns, question=question, granularity=granularity,
+            render_mode=render_mode))
+
+    @reads_index
+    def build_context(self, selected_folders=None, selected_files=None, selected_languages=None, limit=None, concat_method='xml', include_directory=True, metadata_list=None, selected_globs=None, selected_patterns=None, question=None, granularity='file', render_mode='full'):
+        """Same as get_filtered_files, but cached and returning (file_string, token_count)."""
+        key = make_key(
+            self.repo_path,
+            self.index.version(),
+            selected_folders=sorted(selected_folders or []),
+            selected_files=sorted(selected_files or []),
+            selected_languages=sorted(selected_languages or []),
+            selected_globs=sorted(selected_globs or []),
+            selected_patterns=sorted(selected_patterns or []),
+            limit=limit,
+            concat_method=concat_method,
+            include_directory=include_directory,
+            metadata_list=list(metadata_list or []),
+            question=question if limit else None,
+            granularity=granularity if limit else 'file',
+            render_mode=render_mode,
+        )
+        cached = context_cache.get(key)
+        if cached is not None:
+            return cached
+
+        file_string = self.get_filtered_files(selected_folders=selected_folders, selected_files=selected_files,
+                                              selected_languages=selected_languages, limit=limit, concat_method=concat_method,
+                                              include_directory=include_directory, metadata_list=metadata_list,
+                                              selected_globs=selected_globs, selected_patterns=selected_patterns, question=question,
+                                              granularity=granularity, render_mode=render_mode)
+        # counted through the shared memo so num_messages does not encode it again
+        token_count = num_tokens_cached([file_string])[0]
+        context_cache.put(key, (file_string, token_count), len(file_string))
+        return file_string, token_count
+
+    @reads_index
     def get_content_from_file_name(self, file_name):
-        csv_path = os.path.join(self.repo_path, "repo_stats.csv")
-        df = pd.read_csv(csv_path)
+        df = self.index.files()
         df = df[df["file_name"] == file_name]
         row = df.iloc[0]
-        return row["file_content"]
+        return self.index.read_content(row["content_offset"], row["content_length"])
 
+    @reads_index
     def get_folders_options(self):
-        csv_path = os.path.join(self.repo_path, "repo_stats.csv")
-        df = pd.read_csv(csv_path)
+        df = self.index.files()
         file_paths = df['file_path'].dropna().unique()
         # filter out files start with .git
         file_paths = [
@@ -411,41 +1166,61 @@ class RepoService:
         folders = list(set([os.path.dirname(file) for file in file_paths]))
         return sorted(folders)
 
+    @reads_index
+    def get_folder_stats(self):
+        """Map each folder to its (file count, token count), from the stored directory tree."""
+        return self.index.tree().folder_stats()
+
+    @reads_index
     def get_files_options(self):
-        csv_path = os.path.join(self.repo_path, "repo_stats.csv")
-        df = pd.read_csv(csv_path)
+        df = self.index.files()
         # filter out files start with .git
         files = df['file_path'].dropna().unique()
         files = [file for file in files if not file.startswith('.git')]
         return sorted(files)
 
+    @reads_index
+    def get_skipped_files(self):
+        return self.index.skipped_files()
+
+    @reads_index
     def get_languages_options(self):
-        csv_path = os.path.join(self.repo_path, "repo_stats.csv")
-        df = pd.read_csv(csv_path)
+        df = self.index.files()
         languages = df['language'].dropna().unique()
         return sorted(languages)
 
 
 def singleton(cls):
     instances = {}
+    lock = threading.Lock()
 
     def get_instance(*args, **kwargs):
-        if cls not in instances:
-            instances[cls] = cls(*args, **kwargs)
-        return instances[cls]
+        # sessions start in parallel threads, which must not build two instances
+        with lock:
+            if cls not in instances:
+                instances[cls] = cls(*args, **kwargs)
+            return instances[cls]
     return get_instance
 
 
 @singleton
 class RepoManager:
-    def __init__(self):
+    def __init__(self, run_jobs=True):
         logger.info("Initializing RepoManager...")
-        self.repos = {}
+        self.repos = {}  # repo_url -> RepoService, created on first access
+        self.lock = threading.Lock()
         # if no repo dir
         if not os.path.exists(Config["repos_dir"]):
             os.makedirs(Config["repos_dir"], exist_ok=True)
-        self.load_repos()
-        logger.info(f"Loaded {len(self.repos)} repositories.")
+        # clones, updates and deletes run in the background, one at a time per repository
+        self.jobs = JobQueue(self.run_job)
+        self.manifest = RepoManifest(Config["repos_dir"])
+        if not self.manifest.load():
+            # first start, or the manifest was lost: scan repos_dir once
+            self.load_repos()
+        logger.info(f"Loaded {len(self.manifest.urls())} repositories.")
+        if run_jobs:
+            self.jobs.start()
 
     def _find_repos(self):
         repos = []
@@ -453,25 +1228,25 @@ class RepoManager:
         for repo_dir in os.listdir(top_level):
             repo_path = os.path.join(top_level, repo_dir)
             if os.path.isdir(repo_path):
-                if 'repo_stats.csv' in os.listdir(repo_path):
+                if RepoIndex(repo_path).exists():
                     root = repo_path
                     repo_info_path = os.path.join(root, "repo_info.json")
                     repo_url_txt_path = os.path.join(root, "repo_url.txt")
+                    repo_info = {}
 
                     if os.path.exists(repo_info_path):
                         with open(repo_info_path, "r") as f:
-                            # logger.info(f"Reading repo info from {repo_info_path}")
                             try:
                                 repo_info = json.load(f)
-                                repo_url = repo_info.get(
-                                    "repo_url", "").strip('"')
-                                # fix repo_url if it has extra quotes
-                                repo_info['repo_url'] = repo_url
-                                with open(repo_info_path, "w") as f_update:
-                                    json.dump(repo_info, f_update)
                             except json.JSONDecodeError as e:
                                 logger.error(
                                     f"Error decoding JSON from {repo_info_path}: {e}")
+                        repo_url = repo_info.get("repo_url", "")
+                        if repo_url != repo_url.strip('"'):
+                            # fix repo_url if it has extra quotes
+                            repo_url = repo_info['repo_url'] = repo_url.strip('"')
+                            with open(repo_info_path, "w") as f_update:
+                                json.dump(repo_info, f_update)
                     elif os.path.exists(repo_url_txt_path):
                         with open(repo_url_txt_path, "r") as f:
                             repo_url = f.read().strip().strip('"')  # legacy support
@@ -486,61 +1261,225 @@ class RepoManager:
                         repos.append({
                             "repo_name": os.path.basename(root),
                             "repo_url": repo_url,
-                            "last_updated": time.ctime(os.path.getmtime(os.path.join(root, "repo_stats.csv")))
+                            "indexed_sha": repo_info.get("indexed_sha"),
                         })
 
         return repos
 
     def load_repos(self):
-        repo_details = self._find_repos()
-        for repo in repo_details:
-            repo_url = repo["repo_url"]
-            repo_name = repo["repo_name"]
-            self.repos[repo_url] = RepoService(
-                repo_url=repo_url, repo_name=repo_name)
-
-    def add_repo(self, repo_url):
-        if repo_url not in self.repos:
-            repo_service = RepoService(repo_url=repo_url)
-            if repo_service.check_if_exist():
-                self.repos[repo_url] = repo_service
-                logger.info(f"Added repository: {repo_url}")
-            else:
-                logger.error(f"Failed to add repository: {repo_url}")
-                return False
-        else:
+        """Rescan repos_dir and rebuild the manifest from what is on disk."""
+        migrate_legacy_indexes(Config["repos_dir"])
+        entries = []
+        for repo in self._find_repos():
+            index = get_repo_index(os.path.join(Config["repos_dir"], repo["repo_name"]))
+            if index.is_empty():
+                continue
+            file_count, token_count = index.summary()
+            entries.append({**repo, "file_count": file_count, "token_count": token_count,
+                            "status": "ready", "last_updated": index.last_modified()})
+        found = {entry["repo_url"] for entry in entries}
+        # repositories still being added have no index to find yet, unless their add job is gone
+        entries += [entry for entry in self.manifest.pending() if entry["repo_url"] not in found and any(
+            job["kind"] == "add" for job in self.jobs.active_jobs(entry["repo_url"]))]
+        self.manifest.replace_all(entries)
+        with self.lock:
+            self.repos = {repo_url: repo_service for repo_url, repo_service in self.repos.items()
+                          if self.manifest.get(repo_url) is not None}
+
+    def _record(self, repo_service):
+        """Write the current state of a repository's index to the manifest."""
+        file_count, token_count = repo_service.index.summary()
+        self.manifest.set(
+            repo_service.repo_url, repo_name=repo_service.repo_name,
+            indexed_sha=repo_service._read_repo_info().get("indexed_sha"),
+            file_count=file_count, token_count=token_count, status="ready",
+            last_updated=repo_service.index.last_modified())
+
+    def add_repo(self, repo_url, clone_strategy=None, sparse_patterns=None, progress_callback=None):
+        entry = self.manifest.get(repo_url)
+        if entry is not None and entry["status"] not in PENDING_STATUSES:
             logger.warning(f"Repository already exists: {repo_url}")
+            return True
+        if entry is not None:
+            # an add job re-queued after the process stopped part way
+            logger.info(f"Resuming the interrupted add of {repo_url}")
+            self._discard_partial_add(repo_url)
+        self.manifest.set(repo_url, status="adding")
+        try:
+            repo_service = RepoService(
+                repo_url=repo_url, clone_strategy=clone_strategy, sparse_patterns=sparse_patterns,
+                progress_callback=progress_callback)
+        except Exception:
+            self.manifest.remove(repo_url)
+            raise
+        if not repo_service.check_if_exist():
+            self.manifest.remove(repo_url)
+            logger.error(f"Failed to add repository: {repo_url}")
+            return False
+        repo_service.progress_callback = None
+        with self.lock:
+            self.repos[repo_url] = repo_service
+        self._record(repo_service)
+        logger.info(f"Added repository: {repo_url}")
         return True
 
+    def _discard_partial_add(self, repo_url):
+        """Remove the clone and index an interrupted add left behind, unless indexing had finished.
+
+        set_up records indexed_sha only once the index is written, and clone_repo
+        takes any non-empty clone directory as done, so a partial clone has to go.
+        """
+        repo_path = os.path.join(Config["repos_dir"], repo_name_from_url(repo_url))
+        repo_info = {}
+        repo_info_path = os.path.join(repo_path, "repo_info.json")
+        if os.path.exists(repo_info_path):
+            try:
+                with open(repo_info_path, "r") as f:
+                    repo_info = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                pass
+        if repo_info.get("repo_url") not in (None, repo_url):
+            # the directory belongs to another repository with the same name
+            return
+        if "indexed_sha" in repo_info and get_repo_index(repo_path).exists():
+            return
+        release_repo_index(repo_path)
+        if os.path.exists(repo_path):
+            logger.info(f"Removing the partial clone of {repo_url} at {repo_path}")
+            shutil.rmtree(repo_path)
+
     def delete_repo(self, repo_url):
-        if repo_url in self.repos:
-            self.repos[repo_url].delete_repo()
-            del self.repos[repo_url]
+        repo_service = self.get_repo_service(repo_url)
+        if repo_service is not None:
+            deleted = repo_service.delete_repo()
+            with self.lock:
+                self.repos.pop(repo_url, None)
+            self.manifest.remove(repo_url)
             logger.info(f"Deleted repository: {repo_url}")
-        else:
-            logger.warning(f"Repository does not exist: {repo_url}")
+            return deleted
+        logger.warning(f"Repository does not exist: {repo_url}")
+        return False
 
-    def update_all_repos(self):
-        for repo_service in self.repos.values():
-            repo_service.update_repo()
+    def update_repo(self, repo_url, progress_callback=None, ingest_workers=None):
+        repo_service = self.get_repo_service(repo_url)
+        if repo_service is None:
+            logger.warning(f"Repository does not exist: {repo_url}")
+            return False
+        repo_service.progress_callback = progress_callback
+        self.manifest.set(repo_url, status="updating")
+        try:
+            return repo_service.update_repo(ingest_workers=ingest_workers)
+        finally:
+            repo_service.progress_callback = None
+            self._record(repo_service)
+
+    def submit_job(self, kind, repo_url, **params):
+        """Queue an 'add', 'update' or 'delete' job for a repository, returning the job id."""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Invalid job kind: {kind}, expected one of {JOB_KINDS}")
+        return self.jobs.submit(kind, repo_url, **params)
+
+    def run_job(self, kind, repo_url, params, progress):
+        if kind == "add":
+            return self.add_repo(repo_url, progress_callback=progress, **params)
+        if kind == "update":
+            return self.update_repo(repo_url, progress_callback=progress)
+        if kind == "delete":
+            return self.delete_repo(repo_url)
+        raise ValueError(f"Invalid job kind: {kind}, expected one of {JOB_KINDS}")
+
+    def update_all_repos(self, workers=None, check_remote=True):
+        """Update every repository, workers at a time, returning a summary row per repository.
+
+        With check_remote, repositories whose remote head (from ls-remote) is
+        already checked out and indexed are skipped without fetching. Rows hold
+        repo_url, status ('updated', 'unchanged' or 'failed'), seconds and error.
+        The CPU cores are shared out among the repositories indexed at once.
+        """
+        workers = workers or Config.get("update_workers", 8)
+        repo_urls = self.get_repo_urls()
+        # each update may start its own pool of ingest processes
+        ingest_workers = max(1, min(get_ingest_workers(),
+                                    (os.cpu_count() or 1) // max(1, min(workers, len(repo_urls)))))
+
+        def update(repo_url):
+            start_time = time.time()
+            status, error = "failed", None
+            try:
+                repo_service = self.get_repo_service(repo_url)
+                if check_remote and repo_service.is_up_to_date():
+                    status = "unchanged"
+                elif self.update_repo(repo_url, ingest_workers=ingest_workers):
+                    status = "updated"
+                else:
+                    error = "update failed, see the log"
+            except Exception as e:
+                logger.exception(f"Failed to update repository {repo_url}")
+                error = str(e) or type(e).__name__
+            return {"repo_url": repo_url, "status": status,
+                    "seconds": round(time.time() - start_time, 2), "error": error}
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            summary = list(executor.map(update, repo_urls))
+        counts = {status: sum(row["status"] == status for row in summary)
+                  for status in ("updated", "unchanged", "failed")}
+        logger.info(
+            f"Updated {len(summary)} repositories in {time.time() - start_time:.1f}s with {workers} worker(s): {counts}")
+        for row in summary:
+            if row["status"] == "failed":
+                logger.error(f"Failed to update {row['repo_url']}: {row['error']}")
+        return summary
 
     def get_repo_service(self, repo_url) -> RepoService:
-        return self.repos.get(repo_url)
+        """RepoService of an indexed repository, created on first use, or None."""
+        if not self.check_if_repo_exists(repo_url):
+            return None
+        with self.lock:
+            repo_service = self.repos.get(repo_url)
+            if repo_service is None:
+                entry = self.manifest.get(repo_url)
+                repo_service = self.repos[repo_url] = RepoService(
+                    repo_url=repo_url, repo_name=entry["repo_name"])
+        return repo_service
+
+    def get_repo_summary(self, repo_url):
+        """Manifest entry of a repository (file and token counts, indexed commit, status), or None."""
+        return self.manifest.get(repo_url)
 
     def get_repo_urls(self):
-        return list(self.repos.keys())
+        return self.manifest.urls()
 
     def check_if_repo_exists(self, repo_url):
-        return repo_url in self.repos
+        return repo_url in self.manifest.urls()
 
     def isEmpty(self):
-        return len(self.repos) == 0
+        return len(self.manifest.urls()) == 0
+
+
+def main(argv=None):
+    """Command line entry point, e.g. for a nightly cron job: python repo_service.py update-all"""
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage the indexed repositories.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser(
+        "update-all", help="Fetch and re-index every repository in parallel.")
+    update_parser.add_argument("--workers", type=int, default=None,
+                               help="Repositories updated at the same time (default: update_workers in config.yaml).")
+    update_parser.add_argument("--force", action="store_true",
+                               help="Fetch every repository, even if ls-remote shows its head is unchanged.")
+    args = parser.parse_args(argv)
+
+    # leave queued jobs to the app
+    repoManager = RepoManager(run_jobs=False)
+    if args.command == "update-all":
+        summary = repoManager.update_all_repos(
+            workers=args.workers, check_remote=not args.force)
+        if summary:
+            print(pd.DataFrame(summary).to_string(index=False))
+        return 1 if any(row["status"] == "failed" for row in summary) else 0
+    return 0
 
 
 if __name__ == "__main__":
-    # repo_url -> reposervice
-    repoManager = RepoManager()
-    # repo = RepoService("https://github.com/jw782cn/RepoChat-200k")
-    # repo.get_folders()
-    # print(len(repo.get_folders()))
-    # repo.delete_repo()
+    raise SystemExit(main())
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from loguru import logger
+from config import Config
+from lru_eviction import evict_lru
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+
+def get_response_cache_path():
+    return Config.get("response_cache_path") or os.path.join(
+        Config["repos_dir"], ".cache", "response_cache.sqlite3")
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def response_key(model, temperature, messages, context_messages=0):
+    """Cache key of a request: (model, temperature, context hash, remaining messages).
+
+    The first context_messages messages (system prompt and repo context) are
+    hashed on their own into the context hash.
+    """
+    context_hash = _digest(messages[:context_messages])
+    return _digest([model, temperature, context_hash, messages[context_messages:]])
+
+
+class ResponseCache:
+    """Persistent cache of deterministic (temperature 0) chat responses.
+
+    Responses are stored in SQLite with their size and last use time; once the
+    total size passes max_bytes, the least recently used responses are evicted.
+    One instance is shared by all sessions of the process.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or get_response_cache_path()
+        self.max_bytes = max_bytes or Config.get(
+            "response_cache_max_bytes", DEFAULT_MAX_BYTES)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, response):
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, response, len(response.encode("utf-8")), time.time()))
+            self.evict()
+
+    def evict(self):
+        evicted, freed = evict_lru(self.conn, "responses", self.max_bytes, size="size")
+        if evicted:
+            logger.info(
+                f"Evicted {evicted} responses ({freed} bytes) from response cache {self.path}")
+        return evicted
+
+    def close(self):
+        self.conn.close()
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+    return _response_cache
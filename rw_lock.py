@@ -0,0 +1,58 @@
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """Lock shared by any number of readers or held by one writer.
+
+    Waiting writers block new readers so a steady stream of reads cannot starve
+    them, except that a thread already reading may read again (nested calls
+    would deadlock otherwise). A thread must not ask to write while it reads.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self._local, "depth", 0)
+        with self._condition:
+            if not depth and self._writer != threading.get_ident():
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+            self._readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me:
+                # re-entered by the writing thread
+                reentered = True
+            else:
+                reentered = False
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+                self._waiting_writers -= 1
+                self._writer = me
+        try:
+            yield
+        finally:
+            if not reentered:
+                with self._condition:
+                    self._writer = None
+                    self._condition.notify_all()
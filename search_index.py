@@ -0,0 +1,249 @@
+import re
+import json
+import sqlite3
+from array import array
+from collections import Counter, defaultdict, namedtuple
+from context_packing import tokenize_text
+
+SEARCH_FILE = "repo_search.sqlite3"
+# stored as the SQLite user_version; files written by older versions are rebuilt
+SEARCH_VERSION = 3
+# line numbers kept per (identifier, file); enough to point at the usages
+MAX_LINES_PER_TERM = 100
+# keys per SELECT, below SQLite's host parameter limit
+_QUERY_CHUNK = 500
+# pending postings grow with the added content, so bulk builds commit after this much
+COMMIT_FILES = 2000
+COMMIT_BYTES = 32 * 1024 * 1024
+
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+TermStatistics = namedtuple("TermStatistics", [
+    "document_count", "average_length", "document_frequency", "frequencies", "lengths"])
+
+
+def search_version(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def identifier_lines(content):
+    """Map each lower-cased identifier to the (1-based) lines it appears on."""
+    lines = defaultdict(list)
+    for line_number, line in enumerate(content.split('\n'), start=1):
+        for term in {term.lower() for term in _IDENTIFIER.findall(line)}:
+            positions = lines[term]
+            if len(positions) < MAX_LINES_PER_TERM:
+                positions.append(line_number)
+    return lines
+
+
+class SearchIndex:
+    """Persistent inverted index over the contents of a repository index.
+
+    One SQLite file holds three posting tables: identifiers map to the files and
+    line numbers they occur on, character trigrams map to the sorted ids of
+    the files that contain them, and ranking terms (context_packing.tokenize_text
+    of path and content) map to their count in each file. Identifier lookups are
+    answered directly; substring queries intersect the trigram postings to find
+    the few candidate files, which the caller then verifies line by line; the
+    ranking terms give BM25 statistics without reading any content.
+
+    Identifier and ranking term postings are stored one row per (term, file), so
+    replacing a file only deletes and inserts that file's rows. Trigram postings
+    are one compact id array per trigram, rewritten for the trigrams a change
+    touches.
+
+    add() and remove() only collect changes in memory, so readers of the
+    connection see none of them until commit() writes them in one transaction.
+    Bulk builds commit whenever needs_commit() says so, which bounds the memory
+    held by the pending postings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        is_new = not self.conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, length INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS terms (
+                term TEXT NOT NULL, file_id INTEGER NOT NULL, lines TEXT NOT NULL,
+                PRIMARY KEY (term, file_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS terms_file_id ON terms (file_id);
+            CREATE TABLE IF NOT EXISTS ranking_terms (
+                term TEXT NOT NULL, file_id INTEGER NOT NULL, count INTEGER NOT NULL,
+                PRIMARY KEY (term, file_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ranking_terms_file_id ON ranking_terms (file_id);
+            CREATE TABLE IF NOT EXISTS trigrams (trigram TEXT PRIMARY KEY, file_ids BLOB NOT NULL) WITHOUT ROWID;
+        """)
+        if is_new:
+            self.conn.execute(f"PRAGMA user_version = {SEARCH_VERSION}")
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self._next_id = None
+        self._added_files = []
+        self._added_terms = []
+        self._added_ranking_terms = []
+        self._added_trigrams = defaultdict(lambda: array('I'))
+        self._removed_ids = set()
+        self._removed_trigrams = set()
+        self._pending_files = 0
+        self._pending_bytes = 0
+
+    def add(self, file_path, content):
+        """Index one file; remove the old version first when replacing it."""
+        ranking_terms = Counter(tokenize_text(file_path) + tokenize_text(content))
+        if self._next_id is None:
+            self._next_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM files").fetchone()[0]
+        file_id = self._next_id
+        self._next_id += 1
+        self._added_files.append((file_id, file_path, sum(ranking_terms.values())))
+        for trigram in trigrams(content):
+            self._added_trigrams[trigram].append(file_id)
+        self._added_terms += [(term, file_id, json.dumps(lines))
+                              for term, lines in identifier_lines(content).items()]
+        self._added_ranking_terms += [(term, file_id, count) for term, count in ranking_terms.items()]
+        self._pending_files += 1
+        self._pending_bytes += len(content)
+
+    def remove(self, file_path, content):
+        """Drop a file, given the content it was indexed with."""
+        row = self.conn.execute(
+            "SELECT id FROM files WHERE path = ?", (file_path,)).fetchone()
+        if row is None:
+            return
+        self._removed_ids.add(row[0])
+        self._removed_trigrams.update(trigrams(content))
+
+    def needs_commit(self):
+        """Whether a bulk build should commit before adding more files."""
+        return self._pending_files >= COMMIT_FILES or self._pending_bytes >= COMMIT_BYTES
+
+    def commit(self):
+        """Write the pending changes in one transaction; on failure they are rolled back and dropped."""
+        try:
+            self._commit()
+        except BaseException:
+            self.rollback()
+            raise
+
+    def rollback(self):
+        """Drop the pending changes."""
+        self.conn.rollback()
+        self._reset_pending()
+
+    def _commit(self):
+        removed = self._removed_ids
+        removed_rows = [(file_id,) for file_id in removed]
+        self.conn.executemany("DELETE FROM files WHERE id = ?", removed_rows)
+        self.conn.executemany("DELETE FROM terms WHERE file_id = ?", removed_rows)
+        self.conn.executemany("DELETE FROM ranking_terms WHERE file_id = ?", removed_rows)
+        self.conn.executemany("INSERT INTO files (id, path, length) VALUES (?, ?, ?)", self._added_files)
+        # key order keeps the inserts local in the primary key b-tree
+        self.conn.executemany("INSERT INTO terms (term, file_id, lines) VALUES (?, ?, ?)",
+                              sorted(self._added_terms))
+        self.conn.executemany("INSERT INTO ranking_terms (term, file_id, count) VALUES (?, ?, ?)",
+                              sorted(self._added_ranking_terms))
+
+        trigram_keys = self._removed_trigrams | self._added_trigrams.keys()
+        stored = self._fetch("SELECT trigram, file_ids FROM trigrams WHERE trigram IN ({})", trigram_keys)
+        trigram_rows = []
+        for trigram in trigram_keys:
+            file_ids = array('I')
+            if trigram in stored:
+                file_ids.frombytes(stored[trigram])
+                if removed:
+                    file_ids = array('I', [i for i in file_ids if i not in removed])
+            # ids only grow, so appending keeps the postings sorted
+            file_ids.extend(self._added_trigrams.get(trigram, ()))
+            trigram_rows.append((trigram, file_ids.tobytes()))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO trigrams (trigram, file_ids) VALUES (?, ?)",
+            [row for row in trigram_rows if row[1]])
+        self.conn.executemany(
+            "DELETE FROM trigrams WHERE trigram = ?", [(row[0],) for row in trigram_rows if not row[1]])
+
+        self.conn.commit()
+        self._reset_pending()
+
+    def _select(self, sql, keys):
+        keys = list(keys)
+        rows = []
+        for start in range(0, len(keys), _QUERY_CHUNK):
+            chunk = keys[start:start + _QUERY_CHUNK]
+            rows += self.conn.execute(
+                sql.format(', '.join('?' * len(chunk))), chunk).fetchall()
+        return rows
+
+    def _fetch(self, sql, keys):
+        return dict(self._select(sql, keys))
+
+    def close(self):
+        self.conn.close()
+
+    def _paths(self, file_ids):
+        paths = self._fetch("SELECT id, path FROM files WHERE id IN ({})", file_ids)
+        return [paths[file_id] for file_id in file_ids if file_id in paths]
+
+    def find_identifier(self, identifier):
+        """Return [(file_path, [line numbers])] of the files containing the identifier."""
+        rows = self.conn.execute(
+            "SELECT files.path, terms.lines FROM terms JOIN files ON files.id = terms.file_id"
+            " WHERE terms.term = ? ORDER BY terms.file_id", (identifier.lower(),)).fetchall()
+        return [(path, json.loads(lines)) for path, lines in rows]
+
+    def term_statistics(self, terms):
+        """BM25 statistics of ranking terms over all indexed files.
+
+        Returns TermStatistics with the number of files, their average length
+        in ranking terms, the number of files containing each term, and for the
+        files containing any of them, {path: {term: count}} and {path: length}.
+        """
+        document_count, total_length = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM files").fetchone()
+        document_frequency = Counter()
+        frequencies = defaultdict(dict)
+        lengths = {}
+        rows = self._select(
+            "SELECT ranking_terms.term, files.path, ranking_terms.count, files.length"
+            " FROM ranking_terms JOIN files ON files.id = ranking_terms.file_id"
+            " WHERE ranking_terms.term IN ({})", set(terms))
+        for term, path, count, length in rows:
+            document_frequency[term] += 1
+            frequencies[path][term] = count
+            lengths[path] = length
+        return TermStatistics(
+            document_count=document_count,
+            average_length=total_length / document_count if document_count else 0.0,
+            document_frequency=dict(document_frequency),
+            frequencies=dict(frequencies),
+            lengths=lengths,
+        )
+
+    def candidate_files(self, query):
+        """Paths of the files containing every trigram of query, None if query is too short."""
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            return None
+        stored = self._fetch("SELECT trigram, file_ids FROM trigrams WHERE trigram IN ({})", query_trigrams)
+        if len(stored) < len(query_trigrams):
+            return []
+        candidates = None
+        # smallest postings first keeps the intersection small
+        for data in sorted(stored.values(), key=len):
+            file_ids = array('I')
+            file_ids.frombytes(data)
+            candidates = set(file_ids) if candidates is None else candidates.intersection(file_ids)
+            if not candidates:
+                return []
+        return self._paths(sorted(candidates))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules live at the repository root, and config.yaml is read relative to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
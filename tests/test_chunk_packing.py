@@ -0,0 +1,51 @@
+import pytest
+
+import repo_service
+from config import Config
+from repo_index import RepoIndex
+from repo_service import RepoService
+from token_count import num_tokens_from_string
+
+BIG_FILE = ''.join(
+    f'def func_{i}(value):\n    """Return value scaled by {i}."""\n    return value * {i}\n\n\n'
+    for i in range(800))
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.setitem(Config, "content_cache_path", str(tmp_path / "content_cache.sqlite3"))
+    monkeypatch.setitem(Config, "chunk_min_tokens", 2000)
+    monkeypatch.setattr(repo_service, "_content_cache", repo_service.threading.local())
+    clone_path = tmp_path / "repo" / "repo-main"
+    clone_path.mkdir(parents=True)
+    (clone_path / "core.py").write_text('def main():\n    return func_1(2)\n')
+    (clone_path / "big.py").write_text(BIG_FILE)
+
+    service = RepoService.__new__(RepoService)
+    service.repo_name = "repo"
+    service.repo_path = str(tmp_path / "repo")
+    service.clone_path = str(clone_path)
+    service.progress_callback = None
+    service.index = RepoIndex(service.repo_path)
+    service.get_repo_stats(workers=1)
+    return service
+
+
+def build(service, limit, question):
+    context = ''.join(block for block, _ in service.iter_filtered_files(
+        selected_files=['core.py', 'big.py'], limit=limit, question=question, granularity='chunk'))
+    return context, num_tokens_from_string(context.strip())
+
+
+@pytest.mark.parametrize("question", [None, "func_799"])
+@pytest.mark.parametrize("share", [0.5, 0.9, 1.02])
+def test_split_file_fits_the_limit(service, question, share):
+    file_tokens = num_tokens_from_string(BIG_FILE)
+    assert len(service.index.chunks()) == 800
+    limit = int(file_tokens * share)
+    context, tokens = build(service, limit, question)
+    assert '<file name="big.py">' in context
+    assert '<file name="core.py">' in context
+    assert tokens <= limit
+    if question:
+        assert 'return value * 799' in context
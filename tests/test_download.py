@@ -0,0 +1,96 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from config import Config
+from repo_service import RepoService
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 MiB
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD with Range support, dropping the connection after drop_after bytes of a response."""
+
+    drop_after = None
+    requests_seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        start = 0
+        range_header = self.headers.get("Range")
+        self.requests_seen.append(range_header)
+        if range_header:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}")
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.drop_after is not None and len(self.requests_seen) <= 2:
+            # the first two responses are cut short
+            self.wfile.write(body[:self.drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    FlakyHandler.requests_seen = []
+    FlakyHandler.drop_after = None
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/repo.zip"
+    httpd.shutdown()
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setitem(Config, "download_retry_delay", 0)
+    # only what _download_file uses, without cloning anything
+    service = RepoService.__new__(RepoService)
+    service.repo_name = "repo"
+    service.progress_callback = None
+    return service
+
+
+def test_download_resumes_after_dropped_connections(server, service, tmp_path):
+    FlakyHandler.drop_after = 300_000
+    path = tmp_path / "repo.zip.part"
+    service._download_file(server, str(path))
+    assert path.read_bytes() == PAYLOAD
+    first, *resumed = FlakyHandler.requests_seen
+    assert first is None and len(resumed) == 2
+    offsets = [int(header.split("=")[1].rstrip("-")) for header in resumed]
+    assert 0 < offsets[0] < offsets[1] < len(PAYLOAD)
+
+
+def test_download_gives_up_after_download_retries(server, service, tmp_path, monkeypatch):
+    monkeypatch.setitem(Config, "download_retries", 1)
+    FlakyHandler.drop_after = 200_000
+    path = tmp_path / "repo.zip.part"
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        service._download_file(server, str(path))
+    # what arrived is kept for the next attempt
+    assert 0 < os.path.getsize(path) < len(PAYLOAD)
+    assert path.read_bytes() == PAYLOAD[:os.path.getsize(path)]
+
+
+def test_download_continues_existing_partial_file(server, service, tmp_path):
+    path = tmp_path / "repo.zip.part"
+    path.write_bytes(PAYLOAD[:12345])
+    service._download_file(server, str(path))
+    assert path.read_bytes() == PAYLOAD
+    assert FlakyHandler.requests_seen == ["bytes=12345-"]
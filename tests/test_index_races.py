@@ -0,0 +1,51 @@
+import os
+import re
+import threading
+
+import pytest
+
+from repo_index import RepoIndex
+from repo_service import RepoService
+from search_index import SEARCH_FILE
+
+
+def records(version, count=20):
+    return [{'file_name': f'f{i}.py', 'file_path': f'f{i}.py', 'language': 'Python', 'token_count': i + 5,
+             'file_content': f'# {version} file {i}\n' + 'x = 1\n' * i}
+            for i in range(count)]
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = RepoService.__new__(RepoService)
+    service.repo_path = str(tmp_path)
+    service.index = RepoIndex(service.repo_path)
+    service.index.write(records('old'))
+    # replaced contents stay in the blob until it is compacted
+    service.index.patch(records('new', count=10))
+    return service
+
+
+def test_streamed_blocks_survive_a_concurrent_compaction(service):
+    blocks = service.iter_filtered_files(selected_globs=['*.py'], include_directory=False)
+    first, _ = next(blocks)
+    compactor = threading.Thread(target=service.index.compact)
+    compactor.start()
+    # the swap waits until the stream is done with the blob it read the offsets for
+    compactor.join(timeout=0.5)
+    assert compactor.is_alive()
+
+    for block in [first] + [block for block, _ in blocks]:
+        name = re.search(r'<file name="f(\d+)\.py">', block).group(1)
+        version = 'new' if int(name) < 10 else 'old'
+        assert f'# {version} file {name}\n' in block
+    compactor.join()
+    assert len(service.get_filtered_files(selected_globs=['*.py'])) > 0
+
+
+def test_search_rebuild_leaves_no_temporary_files(service):
+    service.index.close_search()
+    os.remove(service.index.search_path)
+    search = service.index.search_index()
+    assert sorted(path for path, _ in search.find_identifier('x')) == sorted(f'f{i}.py' for i in range(1, 20))
+    assert [name for name in os.listdir(service.repo_path) if name.startswith(SEARCH_FILE)] == [SEARCH_FILE]
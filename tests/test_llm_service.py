@@ -0,0 +1,171 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+
+import response_cache
+from config import Config
+from llm_service import ChatClient
+
+REPLY = ["Hello", " world", None, "!"]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible chat completions endpoint answering REPLY after delay seconds.
+
+    The first requests are answered with the status codes in failures, and the
+    number of requests in progress is tracked to check the concurrency limit.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        state = self.server.state
+        with state["lock"]:
+            state["bodies"].append(body)
+            failure = state["failures"].pop(0) if state["failures"] else None
+            state["active"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+        try:
+            if failure is not None:
+                self._send_json(failure, {"error": {"message": "busy"}}, {"Retry-After": "0.05"})
+                return
+            time.sleep(state["delay"])
+            if body.get("stream"):
+                self._stream(body)
+            else:
+                self._send_json(200, {
+                    "id": "x", "object": "chat.completion", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "".join(t for t in REPLY if t)}}],
+                })
+        finally:
+            with state["lock"]:
+                state["active"] -= 1
+
+    def _send_json(self, status, payload, headers=()):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in dict(headers).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = []
+        for text in REPLY:
+            chunk = {"id": "x", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "finish_reason": None,
+                                  "delta": {"content": text} if text is not None else {}}]}
+            events.append(f"data: {json.dumps(chunk)}\n\n".encode())
+        events.append(b"data: [DONE]\n\n")
+        for event in events:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setitem(Config, "llm_max_concurrency", 3)
+    monkeypatch.setitem(Config, "llm_retry_backoff", 0.01)
+    monkeypatch.setitem(Config, "llm_max_retries", 3)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    httpd.state = {"lock": threading.Lock(), "bodies": [], "failures": [], "delay": 0.0,
+                   "active": 0, "max_active": 0}
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+
+
+@pytest.fixture
+def client(server):
+    # pools are per base url, so every test gets its own pool and semaphore
+    return ChatClient(f"http://127.0.0.1:{server.server_address[1]}/v1", "sk-test")
+
+
+def stream_text(client, **kwargs):
+    return "".join(client.stream_text([{"role": "user", "content": "hi"}], model="m", temperature=0.5, **kwargs))
+
+
+def test_retries_rate_limits_and_server_errors(server, client):
+    server.state["failures"] = [429, 503]
+    assert stream_text(client) == "Hello world!"
+    assert len(server.state["bodies"]) == 3
+
+    server.state["failures"] = [502]
+    completion = client.chat([{"role": "user", "content": "hi"}], model="m", stream=False)
+    assert completion.choices[0].message.content == "Hello world!"
+
+
+def test_gives_up_after_max_retries(server, client):
+    server.state["failures"] = [503] * 10
+    with pytest.raises(openai.InternalServerError):
+        stream_text(client)
+    assert len(server.state["bodies"]) == Config["llm_max_retries"] + 1
+
+
+def test_client_errors_are_not_retried(server, client):
+    server.state["failures"] = [400]
+    with pytest.raises(openai.BadRequestError):
+        stream_text(client)
+    assert len(server.state["bodies"]) == 1
+
+
+def test_limits_concurrent_requests(server, client):
+    server.state["delay"] = 0.1
+    replies = []
+    threads = [threading.Thread(target=lambda: replies.append(stream_text(client))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert replies == ["Hello world!"] * 10
+    assert server.state["max_active"] <= 3
+
+
+def test_early_exit_releases_the_slot(server, client):
+    for _ in range(5):
+        for _ in client.chat([{"role": "user", "content": "hi"}], model="m"):
+            break
+    # with every slot leaked, this request would wait forever
+    replies = []
+    thread = threading.Thread(target=lambda: replies.append(stream_text(client)), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert replies == ["Hello world!"]
+
+
+def test_cache_breakpoint_only_for_anthropic_models(server, client):
+    messages = [{"role": "system", "content": "context"}, {"role": "user", "content": "hi"}]
+    list(client.stream_text(messages, model="anthropic/claude-3-haiku", temperature=0.5, context_messages=1))
+    list(client.stream_text(messages, model="gpt-3.5-turbo-16k", temperature=0.5, context_messages=1))
+    anthropic_body, openai_body = server.state["bodies"]
+    assert anthropic_body["messages"][0]["content"] == [
+        {"type": "text", "text": "context", "cache_control": {"type": "ephemeral"}}]
+    assert anthropic_body["messages"][1] == messages[1]
+    assert openai_body["messages"] == messages
+
+
+def test_cached_replies_are_flagged(server, client, monkeypatch, tmp_path):
+    monkeypatch.setitem(Config, "response_cache_path", str(tmp_path / "responses.sqlite3"))
+    monkeypatch.setattr(response_cache, "_response_cache", None)
+    messages = [{"role": "user", "content": "hi"}]
+    first = client.stream_text(messages, model="m", temperature=0)
+    assert "".join(first) == "Hello world!" and not first.cached
+    second = client.stream_text(messages, model="m", temperature=0)
+    assert "".join(second) == "Hello world!" and second.cached
+    assert len(server.state["bodies"]) == 1
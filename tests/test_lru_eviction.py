@@ -0,0 +1,20 @@
+from content_cache import ContentCache
+from response_cache import ResponseCache
+
+
+def test_response_cache_evicts_least_recently_used_bytes(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"), max_bytes=1000)
+    for i in range(4):
+        cache.put(f"k{i}", "x" * 300)
+    assert cache.get("k0") is None
+    assert [cache.get(f"k{i}") is not None for i in range(1, 4)] == [True, True, True]
+    cache.close()
+
+
+def test_content_cache_evicts_down_to_ninety_percent(tmp_path):
+    cache = ContentCache(str(tmp_path / "content.sqlite3"), max_entries=10)
+    cache.put_many([(f"sha{i}", "a.py", 1, "Python", [], {}) for i in range(11)], "cl100k_base", 2000)
+    hits = cache.get_many([(f"sha{i}", "a.py") for i in range(11)], "cl100k_base")
+    # one batch shares its last use, so only the number evicted is fixed
+    assert len(hits) == 9
+    cache.close()
@@ -0,0 +1,24 @@
+import pandas as pd
+
+from path_index import PathIndex, path_keys
+
+PATHS = ['src/a.py', 'src/a/b/c.py', 'README.md', 'docs/x.md', 'src/a/d.txt']
+
+
+def select_globs(patterns):
+    df = pd.DataFrame({'file_path': PATHS, 'language': 'Text'})
+    df['path_key'] = path_keys(df['file_path'])
+    return [PATHS[i] for i in PathIndex(df).select(selected_globs=patterns)]
+
+
+def test_star_stays_within_a_directory():
+    assert select_globs(['src/*.py']) == ['src/a.py']
+
+
+def test_double_star_crosses_directories():
+    assert select_globs(['src/**/*.py']) == ['src/a.py', 'src/a/b/c.py']
+    assert select_globs(['src/**']) == ['src/a.py', 'src/a/b/c.py', 'src/a/d.txt']
+
+
+def test_pattern_without_slash_matches_at_any_depth():
+    assert select_globs(['*.MD']) == ['README.md', 'docs/x.md']
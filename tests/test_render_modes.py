@@ -0,0 +1,36 @@
+from render_modes import render
+
+MARKDOWN = """# Usage
+
+Install the package and run it:
+
+```python
+def main():
+    pass
+```
+"""
+
+PYTHON = '''import os
+
+
+def main(path):
+    """Print the path."""
+    # not part of the outline
+    print(os.path.abspath(path))
+'''
+
+
+def test_outline_keeps_imports_signatures_and_docstrings():
+    assert render(PYTHON, 'Python', 'outline') == 'import os\ndef main(path):\n    """Print the path."""'
+
+
+def test_markdown_outline_falls_back_to_no_comments():
+    outline = render(MARKDOWN, 'Markdown', 'outline')
+    assert outline == render(MARKDOWN, 'Markdown', 'no_comments')
+    assert 'Install the package' in outline
+
+
+def test_empty_outline_falls_back_to_no_comments():
+    content = '{\n  "name": "repo",\n\n  "private": true\n}\n'
+    assert render(content, 'JSON', 'outline') == '{\n  "name": "repo",\n  "private": true\n}'
+    assert render('x = 1\n', 'Python', 'outline') == 'x = 1'
@@ -0,0 +1,62 @@
+import pytest
+
+from search_index import SearchIndex
+
+FILES = {
+    'src/a.py': 'def load_repo():\n    return fetch_data()\n',
+    'src/b.py': 'import os\nvalue = fetch_data()\n',
+    'README.md': 'Load the repo with load_repo.\n',
+}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(str(tmp_path / "search.sqlite3"))
+    for path, content in FILES.items():
+        index.add(path, content)
+    index.commit()
+    yield index
+    index.close()
+
+
+def replace(index, path, content):
+    index.remove(path, FILES[path])
+    index.add(path, content)
+    index.commit()
+
+
+def test_patch_replaces_only_the_changed_file(index):
+    replace(index, 'src/b.py', 'import sys\nvalue = parse_tree()\n')
+
+    assert index.find_identifier('fetch_data') == [('src/a.py', [2])]
+    assert index.find_identifier('parse_tree') == [('src/b.py', [2])]
+    assert index.find_identifier('os') == []
+    assert index.find_identifier('load_repo') == [('src/a.py', [1]), ('README.md', [1])]
+    assert index.candidate_files('fetch_d') == ['src/a.py']
+    assert index.candidate_files('parse_t') == ['src/b.py']
+
+    stats = index.term_statistics(['fetch', 'parse', 'os'])
+    assert stats.document_count == 3
+    assert stats.document_frequency == {'fetch': 1, 'parse': 1}
+    assert set(stats.frequencies) == {'src/a.py', 'src/b.py'}
+
+
+def test_removed_files_leave_no_postings(index):
+    index.remove('src/a.py', FILES['src/a.py'])
+    index.commit()
+
+    assert index.find_identifier('fetch_data') == [('src/b.py', [2])]
+    assert index.candidate_files('load_r') == ['README.md']
+    for table in ('terms', 'ranking_terms'):
+        file_ids = {row[0] for row in index.conn.execute(f"SELECT DISTINCT file_id FROM {table}")}
+        assert file_ids == {row[0] for row in index.conn.execute("SELECT id FROM files")}
+
+
+def test_pending_changes_are_invisible_until_commit(index):
+    index.remove('src/a.py', FILES['src/a.py'])
+    index.add('src/c.py', 'fetch_data = None\n')
+    assert [path for path, _ in index.find_identifier('fetch_data')] == ['src/a.py', 'src/b.py']
+
+    index.rollback()
+    assert [path for path, _ in index.find_identifier('fetch_data')] == ['src/a.py', 'src/b.py']
+    assert index.term_statistics(['fetch']).document_count == 3
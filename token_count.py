@@ -1,19 +1,68 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 import tiktoken
 
-def num_tokens_from_string(string: str, model="gpt-3.5-turbo-0613") -> int:
-    """Returns the number of tokens in a text string based on the specified model's encoding."""
+DEFAULT_MODEL = "gpt-3.5-turbo-0613"
+MAX_CACHED_STRINGS = 4096
+
+_token_cache = OrderedDict()  # (model, content hash) -> number of tokens
+_token_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=DEFAULT_MODEL):
+    """Returns the encoding for the specified model, loading it only once per model."""
     try:
-        encoding = tiktoken.encoding_for_model(model)  # Attempt to get encoding for the specified model
+        return tiktoken.encoding_for_model(model)  # Attempt to get encoding for the specified model
     except KeyError:
         print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")  # Fallback encoding if model's encoding not found
+        return tiktoken.get_encoding("cl100k_base")  # Fallback encoding if model's encoding not found
+
+
+def num_tokens_from_string(string: str, model=DEFAULT_MODEL) -> int:
+    """Returns the number of tokens in a text string based on the specified model's encoding."""
+    return len(get_encoding(model).encode(string, disallowed_special=()))
+
+
+def num_tokens_from_strings(strings, model=DEFAULT_MODEL, num_threads=8) -> list:
+    """Returns the number of tokens of each string, encoding them in parallel threads."""
+    strings = list(strings)
+    if not strings:
+        return []
+    encoded = get_encoding(model).encode_batch(
+        strings, num_threads=num_threads, disallowed_special=())
+    return [len(tokens) for tokens in encoded]
+
+
+def _cache_key(string: str, model: str):
+    return model, hashlib.sha1(string.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def num_tokens_cached(strings, model=DEFAULT_MODEL) -> list:
+    """Like num_tokens_from_strings, but only encodes strings not counted before."""
+    keys = [_cache_key(string, model) for string in strings]
+    with _token_cache_lock:
+        counts = {key: _token_cache[key] for key in keys if key in _token_cache}
+        for key in counts:
+            _token_cache.move_to_end(key)
+
+    missing = {}
+    for key, string in zip(keys, strings):
+        if key not in counts:
+            missing.setdefault(key, string)
+    if missing:
+        new_counts = num_tokens_from_strings(missing.values(), model=model)
+        counts.update(zip(missing.keys(), new_counts))
+        with _token_cache_lock:
+            _token_cache.update(zip(missing.keys(), new_counts))
+            while len(_token_cache) > MAX_CACHED_STRINGS:
+                _token_cache.popitem(last=False)
+
+    return [counts[key] for key in keys]
 
-    num_tokens = len(encoding.encode(string, disallowed_special=()))  # Calculate number of tokens based on encoding
-    return num_tokens
 
-def num_messages(messages: dict, model="gpt-3.5-turbo-0613") -> int:
+def num_messages(messages: dict, model=DEFAULT_MODEL) -> int:
     """Returns the number of tokens in a chat message based on the specified model's encoding."""
-    num_tokens = 0
-    for msg in messages:
-        num_tokens += num_tokens_from_string(msg["content"], model=model)
-    return num_tokens
\ No newline at end of file
+    return sum(num_tokens_cached([msg["content"] for msg in messages], model=model))
@@ -0,0 +1,81 @@
+"""Compare extension-first language detection with guess_lexer_for_filename.
+
+Usage (from the repository root):
+    python useful_tool/benchmark_language_detection.py path/to/repo [--repeat 3]
+"""
+import os
+import sys
+import time
+import argparse
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_filter import FileFilter, is_binary  # noqa: E402
+from language_detect import detect_language, get_language_table, guess_language  # noqa: E402
+
+
+def load_sample(repo_path):
+    file_filter = FileFilter(repo_path)
+    sample = []
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if not file_filter.is_excluded_dir(
+            os.path.relpath(os.path.join(root, d), repo_path))]
+        for file in files:
+            file_path = os.path.join(root, file)
+            rel_path = os.path.relpath(file_path, repo_path)
+            if file_filter.exclusion_reason(rel_path, size=os.path.getsize(file_path), check_parents=False):
+                continue
+            with open(file_path, 'rb') as f:
+                raw = f.read()
+            if not is_binary(raw):
+                sample.append((file_path, raw.decode('utf-8', errors='ignore')))
+    return sample
+
+
+def run(detector, sample, repeat):
+    best = float('inf')
+    results = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [detector(file_path, content) for file_path, content in sample]
+        best = min(best, time.perf_counter() - start)
+    return results, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("repo_path", help="directory of a cloned repository")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per detector, the fastest is reported")
+    args = parser.parse_args()
+
+    sample = load_sample(args.repo_path)
+    if not sample:
+        print("No text files found.")
+        return
+    total_bytes = sum(len(content) for _, content in sample)
+    print(f"Sample: {len(sample)} files, {total_bytes / 1e6:.1f} MB")
+
+    start = time.perf_counter()
+    get_language_table()
+    print(f"Language table built in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    old, old_time = run(guess_language, sample, args.repeat)
+    new, new_time = run(detect_language, sample, args.repeat)
+
+    for label, elapsed in (("guess_lexer_for_filename", old_time), ("extension-first", new_time)):
+        print(f"{label:>26}: {elapsed:.3f} s, {len(sample) / elapsed:,.0f} files/s")
+    print(f"{'speedup':>26}: {old_time / new_time:.1f}x")
+
+    agree = sum(a == b for a, b in zip(old, new))
+    print(f"{'agreement':>26}: {agree}/{len(sample)} ({agree / len(sample):.1%})")
+    disagreements = Counter(
+        (os.path.splitext(file_path)[1] or os.path.basename(file_path), a, b)
+        for (file_path, _), a, b in zip(sample, old, new) if a != b)
+    for (name, a, b), count in disagreements.most_common(10):
+        print(f"  {count:>5} x {name}: {a} -> {b}")
+
+
+if __name__ == "__main__":
+    main()